@@ -1,7 +1,6 @@
 import torch
 import torch.nn.functional as F
 import augment.base_augment as BAug
-import numpy as np
 
 
 def step(values):
@@ -23,13 +22,13 @@ class Ada(BAug.AugmentPipe):
     def update_p(self, batch_size_D):
         # the augmentation probability is updated based on the dicriminator's
         # accuracy on real images
-        accuracy_error = self.lambda_t[1:].mean().cpu() - self.ada_target
-        self.p.copy_(torch.as_tensor(torch.clamp(self.p + np.sign(accuracy_error) * \
-                                                 batch_size_D * self.integration_steps / \
-                                                 (1000 * self.ada_kimg), 0., 1.)))
+        # computed on the device of p, so that training does not wait for the discriminator outputs
+        accuracy_error = self.lambda_t[1:].mean() - self.ada_target
+        self.p.copy_(torch.clamp(self.p + torch.sign(accuracy_error).to(self.p.device) * \
+                                 batch_size_D * self.integration_steps / (1000 * self.ada_kimg), 0., 1.))
 
     def update_lambda(self, lambda_t):
         self.lambda_t.data = torch.cat((self.lambda_t.data, lambda_t.to(self.lambda_t.device).reshape(1,)), 0)
 
     def reset_lambda(self):
-        self.lambda_t.data = torch.zeros((1,))
+        self.lambda_t.data = torch.zeros((1,), device=self.lambda_t.device)
@@ -178,6 +178,12 @@ class AugmentPipe(torch.nn.Module):
             Hz_fbank[i, (Hz_fbank.shape[1] - Hz_hi2.size) // 2 : (Hz_fbank.shape[1] + Hz_hi2.size) // 2] += Hz_hi2
         self.register_buffer('Hz_fbank', torch.as_tensor(Hz_fbank, dtype=torch.float32))
 
+    def __call__(self, images, *args, **kwargs):
+        # The transforms (grid sampling, filter banks, color matrices) run in float32,
+        # also when called inside an autocast region of a mixed precision trainer.
+        with torch.autocast(images.device.type, enabled=False):
+            return super().__call__(images.float(), *args, **kwargs)
+
     def forward(self, images, debug_percentile=None):
         assert isinstance(images, torch.Tensor) and images.ndim == 4
         batch_size, num_channels, height, width = images.shape
@@ -1,22 +1,90 @@
 import numpy as np
-from torch.utils.data import DataLoader
+import torch
+from torch.utils.data import DataLoader, IterableDataset, Sampler, get_worker_info
 from torch.utils.data.dataloader import default_collate
-from torch.utils.data.sampler import SubsetRandomSampler
+
+
+class ResumableSampler(Sampler):
+    """
+    Samples `indices` in an order that only depends on seed and epoch, like utils.torch_utils.misc.InfiniteSampler,
+    and can be resumed in the middle of an epoch.
+
+    `consumed` counts the samples of the current epoch that were used for training. It is advanced by the data loader
+    as batches are taken (the sampler itself runs ahead by the batches prefetched by workers), and iteration starts
+    after it. state_dict/load_state_dict save and restore (epoch, consumed).
+    """
+    def __init__(self, indices, shuffle=True, seed=0):
+        self.indices = np.asarray(indices)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.consumed = 0
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        order = self.indices
+        if self.shuffle:
+            order = order[_epoch_permutation(len(order), self.seed, self.epoch)]
+        return iter(order[self.consumed:].tolist())
+
+    def advance(self, n, worker_id=0):
+        # the batches of the workers are handed out in the order of the indices, so one count covers them all
+        self.consumed += n
+
+    def set_epoch(self, epoch):
+        self.epoch, self.consumed = epoch, 0
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'consumed': self.consumed}
+
+    def load_state_dict(self, state_dict):
+        self.epoch = state_dict['epoch']
+        self.consumed = state_dict['consumed']
+
+
+class _WorkerTaggedCollate:
+    """Collates like `collate_fn` and returns the batch with the id of the worker that made it"""
+    def __init__(self, collate_fn):
+        self.collate_fn = collate_fn
+
+    def __call__(self, samples):
+        worker_info = get_worker_info()
+        return (0 if worker_info is None else worker_info.id), self.collate_fn(samples)
 
 
 class BaseDataLoader(DataLoader):
     """
     Base class for all data loaders
+
+    The position in the data (epoch and samples consumed) is tracked by a ResumableSampler, or by streaming datasets
+    with the same interface (advance, set_epoch, state_dict/load_state_dict), and can be saved and restored with
+    state_dict/load_state_dict. Each worker of a stream reads its own part of it, and once one runs out the batches
+    are no longer taken from the workers in turn, so batches of streams are tagged with their worker and the stream
+    tracks its position per worker.
     """
     def __init__(self, dataset, batch_size, shuffle, train_portion, num_workers, collate_fn=default_collate,
-                 pin_memory=False, drop_last=False):
+                 pin_memory=False, drop_last=False, uint8=False):
         self.train_portion = train_portion
         self.shuffle = shuffle
+        # with uint8 set, the dataset yields uint8 images, which are collated as uint8 and converted to [-1, 1] once
+        # per batch on the device by `uint8_to_float`
+        self.uint8 = uint8
 
         self.batch_idx = 0
         self.n_samples = len(dataset)
 
-        self.sampler = self._split_sampler(self.train_portion)
+        if isinstance(dataset, IterableDataset):
+            # streams have no indices to sample, they shuffle themselves
+            assert train_portion == 1.0, "train portion is not supported for iterable datasets"
+            self.sampler = None
+            self.position = dataset if hasattr(dataset, 'state_dict') else None
+            if self.position is not None:
+                collate_fn = _WorkerTaggedCollate(collate_fn)
+        else:
+            self.sampler = self._split_sampler(self.train_portion)
+            self.position = self.sampler
 
         self.init_kwargs = {
             'dataset': dataset,
@@ -31,26 +99,133 @@ class BaseDataLoader(DataLoader):
 
     def _split_sampler(self, split):
         if split == 1.0:
-            return None
+            train_idx = np.arange(self.n_samples)
+        else:
+            train_idx = _split_indices(self.n_samples, split)
+
+        train_sampler = ResumableSampler(train_idx, shuffle=self.shuffle)
+
+        # turn off shuffle option which is mutually exclusive with sampler
+        self.shuffle = False
+        self.n_samples = len(train_idx)
+
+        return train_sampler
 
-        idx_full = np.arange(self.n_samples)
+    def __iter__(self):
+        if self.position is None:
+            return super().__iter__()
+        return self._tracked_iter()
 
-        np.random.seed(0)
-        np.random.shuffle(idx_full)
+    def _tracked_iter(self):
+        # `position` advances by the batches handed out, not by those already loaded ahead by the workers
+        position, epoch = self.position, self.position.epoch
+        epoch_size = len(position) // self.batch_size * self.batch_size if self.drop_last else len(position)
+        tagged = isinstance(self.collate_fn, _WorkerTaggedCollate)
+        for batch in super().__iter__():
+            worker_id, batch = batch if tagged else (0, batch)
+            position.advance(len(batch[0]), worker_id)
+            if position.consumed >= epoch_size:
+                # roll over with the last batch, so that the epoch is complete even if it is never iterated past
+                position.set_epoch(epoch + 1)
+            yield batch
+        if position.epoch == epoch:
+            position.set_epoch(epoch + 1)
 
-        if isinstance(split, int):
-            assert split > 0
-            assert split < self.n_samples, "train portion is configured to be larger than entire dataset."
-            len_train = split
+    def state_dict(self):
+        return self.position.state_dict() if self.position is not None else {}
+
+    def load_state_dict(self, state_dict):
+        if self.position is not None and state_dict:
+            self.position.load_state_dict(state_dict)
+
+
+def uint8_to_float(imgs):
+    """uint8 images in [0, 255] to floats in [-1, 1], the same as ToTensor followed by Normalize(0.5, 0.5)"""
+    return imgs.float().div_(127.5).sub_(1)
+
+
+def _epoch_permutation(n, seed, epoch):
+    """Shuffled order of an epoch, independent of the global random state"""
+    return np.random.RandomState([seed, epoch]).permutation(n)
+
+
+def _split_indices(n_samples, split):
+    """Indices of the training portion `split` (a fraction, or a number of samples) of a dataset"""
+    idx_full = np.arange(n_samples)
+
+    np.random.seed(0)
+    np.random.shuffle(idx_full)
+
+    if isinstance(split, int):
+        assert split > 0
+        assert split < n_samples, "train portion is configured to be larger than entire dataset."
+        len_train = split
+    else:
+        len_train = int(n_samples * split)
+
+    return idx_full[0:len_train]
+
+
+class BaseGPUDataLoader:
+    """
+    Base class for data loaders that keep the whole dataset on the device
+
+    The images are uploaded once as a uint8 (N, C, H, W) tensor. Every epoch is then shuffled, batched, normalized to
+    [-1, 1] and optionally flipped with tensor ops on the device, so there are no workers, no collate and no
+    host-to-device copies per step. Yields (imgs, labels) batches like `BaseDataLoader`, in an order that only
+    depends on seed and epoch, and saves and restores its position with state_dict/load_state_dict.
+    """
+    def __init__(self, images, labels, batch_size, shuffle, train_portion, drop_last=False, flip=False, device=None,
+                 seed=0):
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.flip = flip
+        self.train_portion = train_portion
+        self.seed = seed
+        self.epoch = 0
+        self.consumed = 0
+
+        images = torch.as_tensor(images)
+        assert images.dtype == torch.uint8 and images.dim() == 4, "images must be a uint8 (N, C, H, W) tensor"
+        labels = torch.ones(len(images), dtype=torch.long) if labels is None else torch.as_tensor(labels)
+        if train_portion != 1.0:
+            train_idx = torch.from_numpy(_split_indices(len(images), train_portion))
+            images, labels = images[train_idx], labels[train_idx]
+
+        self.images = images.to(self.device)
+        self.labels = labels.to(self.device)
+        self.n_samples = len(self.images)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n_samples // self.batch_size
+        return -(-self.n_samples // self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.from_numpy(_epoch_permutation(self.n_samples, self.seed, self.epoch)).to(self.device)
         else:
-            len_train = int(self.n_samples * split)
+            order = torch.arange(self.n_samples, device=self.device)
 
-        train_idx = idx_full[0:len_train]
+        for i in range(self.consumed // self.batch_size, len(self)):
+            idx = order[i * self.batch_size:(i + 1) * self.batch_size]
+            imgs = uint8_to_float(self.images[idx])
+            if self.flip:
+                flipped = torch.rand(len(idx), 1, 1, 1, device=self.device) < 0.5
+                imgs = torch.where(flipped, imgs.flip(3), imgs)
+            self.consumed += len(idx)
+            if i == len(self) - 1:
+                self.epoch, self.consumed = self.epoch + 1, 0
+            yield imgs, self.labels[idx]
 
-        train_sampler = SubsetRandomSampler(train_idx)
+    def state_dict(self):
+        return {'epoch': self.epoch, 'consumed': self.consumed}
 
-        # turn off shuffle option which is mutually exclusive with sampler
-        self.shuffle = False
-        self.n_samples = len(train_idx)
+    def load_state_dict(self, state_dict):
+        self.epoch = state_dict['epoch']
+        self.consumed = state_dict['consumed']
 
-        return train_sampler
\ No newline at end of file
@@ -5,10 +5,24 @@ from abc import abstractmethod
 from logger import TensorboardWriter, Wandb
 from parse_config import ConfigParser
 import torch.nn as nn
-from utils import inf_loop, MetricTracker
+from utils import inf_loop, MetricTracker, DevicePrefetcher
+from utils.fid_evaluator import FIDEvaluator
+from utils.memory import MemoryPolicy
+from base.base_data_loader import uint8_to_float
 import numpy as np
 import wandb
-import gc
+from copy import deepcopy
+
+# trainer.amp values and the autocast dtype they select
+AMP_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def _to_float(out):
+    """Casts the tensors of a network output (tensor, or nested lists and tuples of tensors) to float32"""
+    if isinstance(out, (list, tuple)):
+        return type(out)(_to_float(o) for o in out)
+    return out.float()
+
 
 class BaseGANTrainer:
     """
@@ -36,14 +50,21 @@ class BaseGANTrainer:
         self.checkpoint_dir = config.save_dir
         self.config = config
         self.device = device
+        # the loader itself, without prefetching or inf_loop
+        self.data_source = data_loader
         self.data_loader = data_loader
+        if cfg_trainer.get('prefetch', 0) > 0:
+            # keep the next batches already on the device, copied on a side stream
+            self.data_loader = DevicePrefetcher(data_loader, device, depth=cfg_trainer['prefetch'])
+        # position in the data of the batches taken for training, saved in checkpoints to resume mid-epoch
+        self.data_position = self.data_loader if hasattr(data_loader, 'state_dict') else None
         self.augment = augment
         if len_epoch is None:
             # epoch-based training
             self.len_epoch = len(self.data_loader)
         else:
             # iteration-based training
-            self.data_loader = inf_loop(data_loader)
+            self.data_loader = inf_loop(self.data_loader)
             self.len_epoch = len_epoch
         self.lr_scheduler_G = lr_scheduler_G
         self.lr_scheduler_D = lr_scheduler_D
@@ -63,42 +84,109 @@ class BaseGANTrainer:
                               "to choose appropriate module")
         self.iters = 0
         self.lambda_t = list()
+        # optional cheap FID estimate during training, see _monitor_fid
+        self.cfg_fid = cfg_trainer.get('fid', None)
+        self.fid_evaluator = None
+
+        # garbage collection and CUDA cache policy of the training loop, see MemoryPolicy
+        self.memory = MemoryPolicy(device=device, **cfg_trainer.get('memory', {}))
+        # with reuse_fakes set, the generator runs once per iteration and its output is used by both the D and G steps
+        self.reuse_fakes = cfg_trainer.get('reuse_fakes', False)
+        # mixed precision: with amp set to bf16 or fp16, the G and D forwards run in autocast and their outputs are cast
+        # back to float32, so that losses and augmentations are computed in full precision. fp16 gradients are scaled
+        # by a GradScaler per network; with amp unset (or bf16) the scalers are disabled and pass losses through.
+        amp = cfg_trainer.get('amp', None)
+        assert amp is None or amp in AMP_DTYPES, "amp must be one of {} or unset".format(list(AMP_DTYPES))
+        self.amp_dtype = AMP_DTYPES.get(amp)
+        self.device_type = torch.device(device).type
+        # CPU autocast only supports bf16
+        assert amp != 'fp16' or self.device_type == 'cuda', "amp fp16 needs a CUDA device, use bf16 on CPU"
+        self.scaler_G = torch.cuda.amp.GradScaler(enabled=amp == 'fp16')
+        self.scaler_D = torch.cuda.amp.GradScaler(enabled=amp == 'fp16')
 
         if config.resume is not None:
             self._resume_checkpoint(config.resume)
+        # with deferred_metrics set, metrics stay on the device and are read back at log steps instead of every step;
+        # values are sent to the writer in batches of writer_flush_interval
         self.train_metrics = MetricTracker('g_loss', 'd_loss', 'D(G(z))', 'D(x)', 'p', 'd_out_real', 'd_out_fake',
-                                           writer=self.writer)
+                                           writer=self.writer, deferred=cfg_trainer.get('deferred_metrics', False),
+                                           flush_interval=cfg_trainer.get('writer_flush_interval', 1))
+
+    def _sample_real_batch(self):
+        """A batch of real images for logging, taken without moving the training position in the data"""
+        state = deepcopy(self.data_source.state_dict()) if self.data_position is not None else None
+        real_imgs = next(iter(self.data_source))[0]
+        if state is not None:
+            self.data_source.load_state_dict(state)
+        return self._prepare_real(real_imgs)
+
+    def _prepare_real(self, real_imgs):
+        """
+        Moves a batch of real images to the device. uint8 batches (loaders with uint8 set) are converted to [-1, 1]
+        there, once per batch.
+        """
+        real_imgs = real_imgs.to(self.device, non_blocking=True)
+        if real_imgs.dtype == torch.uint8:
+            real_imgs = uint8_to_float(real_imgs)
+        return real_imgs
 
     def _sample_noise(self, batch_size):
         return torch.randn(batch_size, self.model.latent_dim).to(self.device)
 
+    def _autocast(self):
+        """Autocast context of the G and D forwards, a no-op unless amp is set"""
+        return torch.autocast(self.device_type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
+
+    def _forward_G(self, z):
+        with self._autocast():
+            gen_imgs = self.model.generator(z)
+        return _to_float(gen_imgs)
+
+    def _forward_D(self, imgs, **kwargs):
+        with self._autocast():
+            out = self.model.discriminator(imgs, **kwargs)
+        return _to_float(out)
+
+    def _generate(self):
+        """A batch of generated images, kept in the generator's graph"""
+        z = self._sample_noise(self.current_batch_size)
+        return self._forward_G(z)
+
+    def _shared_fakes(self):
+        """The generated images shared by the D and G steps of an iteration if reuse_fakes is set, else None"""
+        return self._generate() if self.reuse_fakes else None
+
     def gen_loss(self, gen_imgs):
-        disc_out = self.model.discriminator(gen_imgs).requires_grad_(True)
+        disc_out = self._forward_D(gen_imgs).requires_grad_(True)
         g_loss = self.criterion(disc_out, self.valid[:self.current_batch_size])
 
-        return g_loss, disc_out.detach().cpu()
+        return g_loss, disc_out.detach()
 
     def d_fake_loss(self, gen_imgs):
-        d_out_fake = self.model.discriminator(gen_imgs).requires_grad_(True)
+        d_out_fake = self._forward_D(gen_imgs).requires_grad_(True)
 
         d_fake_loss = self.criterion(d_out_fake, self.fake[:self.current_batch_size])
 
-        return d_fake_loss, d_out_fake.detach().cpu()
+        return d_fake_loss, d_out_fake.detach()
 
     def d_real_loss(self, real_imgs):
-        d_out_real = self.model.discriminator(real_imgs).requires_grad_(True)
+        d_out_real = self._forward_D(real_imgs).requires_grad_(True)
 
         d_real_loss = self.criterion(d_out_real, self.valid[:self.current_batch_size])
 
-        return d_real_loss, d_out_real.detach().cpu()
-    def _train_D(self, real_imgs):
-        """Function for training D, returning current loss and D's probability predictions on real samples"""
-        self.optimizer_D.zero_grad()
-        # Sample noise as generator input
-        z = self._sample_noise(self.current_batch_size)
-        # Generate a batch of images
+        return d_real_loss, d_out_real.detach()
+    def _train_D(self, real_imgs, gen_imgs=None):
+        """
+        Function for training D, returning current loss and D's probability predictions on real samples
 
-        gen_imgs = self.model.generator(z)
+        :param gen_imgs: Generated images shared with the G step (see reuse_fakes), generated here if None.
+        """
+        self.optimizer_D.zero_grad()
+        # Generate a batch of images, no gradient flows back to the generator in this step
+        if gen_imgs is None:
+            with torch.no_grad():
+                gen_imgs = self._generate()
+        gen_imgs = gen_imgs.detach()
 
         # Augment real and generated images
         if self.augment is not None:
@@ -112,40 +200,44 @@ class BaseGANTrainer:
 
         d_loss = d_real_loss + d_fake_loss
 
-        d_loss.backward()
+        self.scaler_D.scale(d_loss).backward()
 
-        self.optimizer_D.step()
+        self.scaler_D.step(self.optimizer_D)
+        self.scaler_D.update()
 
         ###LOG
         d_x = (0.5 * torch.mean(nn.Sigmoid()(d_out_real)) +
-               0.5 * torch.mean(1 - nn.Sigmoid()(d_out_fake))).detach().cpu().numpy()
-        self.train_metrics.update('d_out_real', d_out_real.numpy().mean())
+               0.5 * torch.mean(1 - nn.Sigmoid()(d_out_fake)))
+        self.train_metrics.update('d_out_real', d_out_real.mean())
         self.train_metrics.update('D(x)', d_x)
         del d_x
-        gc.collect()
 
-        return d_loss.item(), d_out_real.detach()
+        return d_loss.detach(), d_out_real
 
-    def _train_G(self):
-        self.optimizer_G.zero_grad()
-        z = self._sample_noise(self.current_batch_size)
+    def _train_G(self, gen_imgs=None):
+        """
+        Function for training G, returning current loss
 
-        gen_imgs = self.model.generator(z)
+        :param gen_imgs: Generated images shared with the D step (see reuse_fakes), generated here if None.
+        """
+        self.optimizer_G.zero_grad()
+        if gen_imgs is None:
+            gen_imgs = self._generate()
         # Augment generated images
         if self.augment is not None:
             gen_imgs = self.augment(gen_imgs)
     
         g_loss, d_out_g = self.gen_loss(gen_imgs)
-        g_loss.backward()
+        self.scaler_G.scale(g_loss).backward()
 
-        self.optimizer_G.step()
-        d_gz = torch.mean(nn.Sigmoid()(d_out_g)).detach().cpu().numpy()
+        self.scaler_G.step(self.optimizer_G)
+        self.scaler_G.update()
+        d_gz = torch.mean(nn.Sigmoid()(d_out_g))
         self.train_metrics.update('D(G(z))', d_gz)
-        self.train_metrics.update('d_out_fake', d_out_g.numpy().mean())
+        self.train_metrics.update('d_out_fake', d_out_g.mean())
         del d_gz, d_out_g
-        gc.collect()
 
-        return g_loss.item()
+        return g_loss.detach()
 
     @abstractmethod
     def _train_epoch(self, epoch):
@@ -160,12 +252,14 @@ class BaseGANTrainer:
         """
         Full training logic
         """
+        self.memory.freeze()
         for epoch in range(self.start_epoch, self.epochs + 1):
             result = self._train_epoch(epoch)
 
             # save logged informations into log dict
             log = {'epoch': epoch}
             log.update(result)
+            log.update(self.memory.stats())
 
             # print logged informations to the screen
             for key, value in log.items():
@@ -195,6 +289,9 @@ class BaseGANTrainer:
             'lr_scheduler_G': self.lr_scheduler_G.state_dict(),
             'lr_scheduler_D': self.lr_scheduler_D.state_dict(),
             'augment': self.augment.state_dict() if self.augment else None,
+            'scaler_G': self.scaler_G.state_dict(),
+            'scaler_D': self.scaler_D.state_dict(),
+            'data_loader': self.data_position.state_dict() if self.data_position is not None else None,
             'config': self.config
         }
         filename = str(self.checkpoint_dir) + f'/{epoch}.pth'.zfill(4)
@@ -254,6 +351,15 @@ class BaseGANTrainer:
         if self.augment:
             self.augment.load_state_dict(checkpoint['augment'])
 
+        # load the loss scales of fp16 training, absent (or empty) in checkpoints of other runs
+        if checkpoint.get('scaler_G'):
+            self.scaler_G.load_state_dict(checkpoint['scaler_G'])
+            self.scaler_D.load_state_dict(checkpoint['scaler_D'])
+
+        # load the position in the data, so that the run continues with the batches it would have taken next
+        if checkpoint.get('data_loader') is not None and self.data_position is not None:
+            self.data_position.load_state_dict(checkpoint['data_loader'])
+
         self.logger.info("Checkpoint loaded. Resume training from epoch {}".format(self.start_epoch))
 
     def _valid_epoch(self, epoch):
@@ -277,10 +383,9 @@ class BaseGANTrainer:
                     del images
 
                 del noise, fake_imgs
-                gc.collect()
 
             # Add 32 real images to tensorboard
-            real_imgs, _ = next(iter(self.data_loader))
+            real_imgs = self._sample_real_batch()
             self.writer.set_step(epoch, 'valid')
             if self.writer.name == "tensorboard":
                 self.writer.add_image('real', make_grid(real_imgs[:32], nrow=8, normalize=True))
@@ -290,7 +395,36 @@ class BaseGANTrainer:
                 del images
 
             del real_imgs
-            gc.collect()
+
+        self._monitor_fid(epoch)
+
+    def _monitor_fid(self, step):
+        """
+        Estimate FID from a small number of samples with a bootstrap confidence interval, if the "fid" entry is
+        configured in the trainer config and `step` is a multiple of its "interval"
+
+        :param step: Integer, current epoch (or iteration for iteration-based trainers).
+        """
+        if not self.cfg_fid or step % self.cfg_fid.get('interval', 1) != 0:
+            return
+        if self.fid_evaluator is None:
+            # inception and the reference statistics are loaded once and kept for the whole run
+            self.fid_evaluator = FIDEvaluator(self.cfg_fid['stats'], batch_size=self.cfg_fid.get('batch_size', 50),
+                                              device=self.device,
+                                              sqrtm_method=self.cfg_fid.get('sqrtm', 'eigh'))
+        result = self.fid_evaluator.score_generator_subset(self.model.generator, self.model.latent_dim,
+                                                           n_sample=self.cfg_fid.get('n_sample', 2000),
+                                                           n_bootstrap=self.cfg_fid.get('n_bootstrap', 10),
+                                                           fid_infinity=self.cfg_fid.get('fid_infinity', False))
+        self.logger.info('FID ({} samples): {:.3f} [{:.3f}, {:.3f}]'.format(
+            self.cfg_fid.get('n_sample', 2000), result['fid'], result['fid_lo'], result['fid_hi']))
+        if self.writer is not None:
+            self.writer.set_step(step, 'valid')
+            for key, value in result.items():
+                if self.writer.name == "tensorboard":
+                    self.writer.add_scalar(key, value)
+                else:
+                    self.writer.log({key: value}, step=None)
 
     def _progress(self, batch_idx):
         base = '[{}/{} ({:.0f}%)]'
@@ -0,0 +1,232 @@
+"""This module benchmarks the data loaders of data_loader/data_loaders.py over a grid of workers, pin_memory, batch
+sizes and storage formats, to tell whether training is bound by data loading"""
+
+import inspect
+import io
+import itertools
+import os
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+
+import data_loader.data_loaders as module_data
+from base.base_data_loader import BaseDataLoader, uint8_to_float
+from data_loader.custom_datasets import DECODE_BACKENDS, MemmapImageDataset, TarShardDataset
+from utils import inf_loop, read_json
+
+LOADERS = ('MnistDataLoader', 'CelebA64DataLoader', 'Cifar10DataLoader', 'HighResolutionDataLoader')
+# loader argument each storage format needs, 'folder' is the dataset the loader reads by default
+FORMAT_ARGS = {'folder': None, 'packed': 'packed_path', 'tar': 'shard_dir'}
+STAGES = ('open', 'decode', 'transform', 'collate', 'h2d', 'h2d_pinned')
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _timed_items(dataset, n):
+    """
+    Yields ((open, decode, transform) seconds, sample) for the first n items of dataset, loaded the way its
+    __getitem__ or __iter__ does. Reading the file (or page) is `open`, and `decode` is 0 for pre-decoded data.
+    """
+    clock = time.perf_counter
+    if isinstance(dataset, TarShardDataset):
+        records = dataset._records(dataset.shards, 1, 0)
+        for _ in range(n):
+            t0 = clock()
+            _, data = next(records)
+            t1 = clock()
+            img = Image.open(io.BytesIO(data))
+            img.load()
+            t2 = clock()
+            sample = (dataset.transform(img), 1)
+            yield (t1 - t0, t2 - t1, clock() - t2), sample
+        records.close()
+        return
+
+    images = np.load(dataset.packed_path, mmap_mode='r') if isinstance(dataset, MemmapImageDataset) else None
+    for index in range(min(n, len(dataset))):
+        t0 = clock()
+        if images is not None:
+            img = torch.from_numpy(np.array(images[index]))
+        elif hasattr(dataset, 'img_paths'):
+            # backends other than PIL decode when opening
+            img = getattr(dataset, 'decoder', Image.open)(dataset.img_paths[index])
+        else:
+            # torchvision datasets keep decoded arrays in memory
+            arr = dataset.data[index]
+            img = Image.fromarray(arr.numpy() if isinstance(arr, torch.Tensor) else arr)
+        t1 = clock()
+        if isinstance(img, Image.Image):
+            img.load()
+        t2 = clock()
+        sample = (dataset.transform(img) if dataset.transform else img, 1)
+        yield (t1 - t0, t2 - t1, clock() - t2), sample
+
+
+def profile_stages(loader, device, num_batches=10):
+    """
+    Average seconds per batch of each loading stage, measured in this process on num_batches batches. h2d is the copy
+    of a pageable batch to the device, h2d_pinned the copy including pinning the batch first.
+    """
+    times = dict.fromkeys(STAGES, 0.0)
+    items = _timed_items(loader.dataset, num_batches * loader.batch_size)
+    for _ in range(num_batches):
+        samples = []
+        for (t_open, t_decode, t_transform), sample in itertools.islice(items, loader.batch_size):
+            times['open'] += t_open
+            times['decode'] += t_decode
+            times['transform'] += t_transform
+            samples.append(sample)
+        if not samples:
+            break
+        t0 = time.perf_counter()
+        # the collate of streams is wrapped to tag batches with their worker
+        collate_fn = getattr(loader.collate_fn, 'collate_fn', loader.collate_fn)
+        imgs = collate_fn(samples)[0]
+        times['collate'] += time.perf_counter() - t0
+
+        if device.type == 'cuda':
+            _sync(device)
+            t0 = time.perf_counter()
+            imgs.to(device)
+            _sync(device)
+            t1 = time.perf_counter()
+            imgs.pin_memory().to(device, non_blocking=True)
+            _sync(device)
+            times['h2d'] += t1 - t0
+            times['h2d_pinned'] += time.perf_counter() - t1
+    return {stage: t / num_batches for stage, t in times.items()}
+
+
+def measure_throughput(loader, device, num_batches=50, warmup=5):
+    """
+    Images per second of the loader including the copy to the device, and CPU cores used on average by this process
+    and its workers over the run (including worker start-up and shutdown)
+    """
+    assert len(loader) > 0, "the loader has no batches"
+    cpu_start, wall_start = os.times(), time.perf_counter()
+    batches = inf_loop(loader)
+    n_imgs = 0
+    for step in range(warmup + num_batches):
+        if step == warmup:
+            _sync(device)
+            start, n_imgs = time.perf_counter(), 0
+        imgs = next(batches)[0].to(device, non_blocking=True)
+        if getattr(loader, 'uint8', False):
+            imgs = uint8_to_float(imgs)
+        n_imgs += len(imgs)
+    _sync(device)
+    elapsed = time.perf_counter() - start
+    # shuts the workers down, so that their CPU time is accounted to this process' children
+    batches.close()
+    cpu_end, wall = os.times(), time.perf_counter() - wall_start
+
+    cpu = sum(cpu_end[:4]) - sum(cpu_start[:4])
+    return n_imgs / elapsed, cpu / wall
+
+
+def _loader_kwargs(args, base_kwargs, params, fmt, uint8, decode, batch_size):
+    """Arguments of one loader of the grid, or None if the loader does not support the format"""
+    kwargs = dict(base_kwargs, batch_size=batch_size)
+    if decode != 'pil':
+        if 'decode' not in params or fmt != 'folder':
+            return None
+        kwargs['decode'] = decode
+    for arg in FORMAT_ARGS.values():
+        kwargs.pop(arg, None)
+    if FORMAT_ARGS[fmt] is not None:
+        if FORMAT_ARGS[fmt] not in params:
+            return None
+        kwargs[FORMAT_ARGS[fmt]] = args.packed_path if fmt == 'packed' else args.shard_dir
+    if 'uint8' in params:
+        kwargs['uint8'] = bool(uint8)
+    elif uint8:
+        return None
+    if args.img_size is not None and 'img_size' in params:
+        kwargs['img_size'] = args.img_size
+    return kwargs
+
+
+def main(args):
+    device = torch.device(args.device if args.device else ('cuda' if torch.cuda.is_available() else 'cpu'))
+    if args.config is not None:
+        # benchmark the loader of a training config, with the grid on top of its args
+        config = read_json(args.config)
+        loader_names, base_kwargs = [config['data_loader']['type']], dict(config['data_loader']['args'])
+    else:
+        loader_names, base_kwargs = args.loaders, {'data_dir': args.data_dir}
+    batch_sizes = args.batch_size or [base_kwargs.get('batch_size', 64)]
+
+    rows = []
+    grid = itertools.product(loader_names, args.formats, args.uint8, args.decode, batch_sizes)
+    for name, fmt, uint8, decode, batch_size in grid:
+        cls = getattr(module_data, name)
+        params = inspect.signature(cls.__init__).parameters
+        kwargs = _loader_kwargs(args, base_kwargs, params, fmt, uint8, decode, batch_size)
+        if kwargs is None:
+            continue
+
+        try:
+            stages = {}
+            if issubclass(cls, BaseDataLoader):
+                stages = profile_stages(cls(**dict(kwargs, num_workers=0)), device, args.profile_batches)
+            for num_workers, pin_memory in itertools.product(args.num_workers, args.pin_memory):
+                loader = cls(**dict(kwargs, num_workers=num_workers, pin_memory=bool(pin_memory)))
+                ips, cores = measure_throughput(loader, device, args.num_batches, args.warmup)
+                row = {'loader': name, 'format': fmt, 'uint8': uint8, 'decode': decode, 'batch_size': batch_size,
+                       'num_workers': num_workers, 'pin_memory': pin_memory, 'img/s': ips, 'cpu_cores': cores,
+                       'cpu_%': 100 * cores / os.cpu_count()}
+                row.update({stage + '_ms': 1000 * t for stage, t in stages.items()})
+                if args.train_ips is not None:
+                    row['bound'] = 'loader' if ips < args.train_ips else 'compute'
+                rows.append(row)
+                print(', '.join('{}: {:.4g}'.format(k, v) if isinstance(v, float) else '{}: {}'.format(k, v)
+                                for k, v in row.items()))
+        except (OSError, RuntimeError, AssertionError, ImportError) as e:
+            print('Skipping {} ({}, uint8={}, decode={}, batch_size={}): {}'.format(name, fmt, uint8, decode,
+                                                                                  batch_size, e))
+
+    if not rows:
+        return
+    results = pd.DataFrame(rows)
+    with pd.option_context('display.max_columns', None, 'display.width', 200, 'display.float_format', '{:.3g}'.format):
+        print(results)
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-c", "--config", default=None, type=str,
+                        help="training config whose data loader is benchmarked, instead of --loaders")
+    parser.add_argument("-l", "--loaders", default=LOADERS, nargs="+", type=str,
+                        help="data loader classes of data_loader/data_loaders.py")
+    parser.add_argument("-p", "--data_dir", default="data/", type=str, help="path to dataset dir")
+    parser.add_argument("-f", "--formats", default=["folder"], nargs="+", type=str, choices=list(FORMAT_ARGS),
+                        help="folder: the loader's dataset, packed: --packed_path, tar: --shard_dir")
+    parser.add_argument("-pp", "--packed_path", default=None, type=str, help="dataset packed by pack_dataset.py")
+    parser.add_argument("-sd", "--shard_dir", default=None, type=str, help="tar shards written by pack_dataset.py")
+    parser.add_argument("-w", "--num_workers", default=[0, 1, 2, 4], nargs="+", type=int)
+    parser.add_argument("-pm", "--pin_memory", default=[0, 1], nargs="+", type=int, choices=[0, 1])
+    parser.add_argument("-bs", "--batch_size", default=None, nargs="+", type=int,
+                        help="batch sizes, by default that of the config or 64")
+    parser.add_argument("-u", "--uint8", default=[0], nargs="+", type=int, choices=[0, 1],
+                        help="1: collate uint8 and normalize on the device")
+    parser.add_argument("-dc", "--decode", default=["pil"], nargs="+", type=str, choices=DECODE_BACKENDS + ("auto",),
+                        help="JPEG decode backends of the folder datasets that support them, see ImageDecoder")
+    parser.add_argument("-s", "--img_size", default=None, type=int, help="img_size argument of the loaders")
+    parser.add_argument("-nb", "--num_batches", default=50, type=int, help="number of timed batches per setting")
+    parser.add_argument("-wb", "--warmup", default=5, type=int, help="untimed batches, including worker start-up")
+    parser.add_argument("-pb", "--profile_batches", default=10, type=int, help="batches timed stage by stage")
+    parser.add_argument("-ti", "--train_ips", default=None, type=float,
+                        help="images/sec consumed by the training step, to mark settings as loader or compute bound")
+    parser.add_argument("-d", "--device", default=None, type=str)
+    parser.add_argument("-o", "--output", default=None, type=str, help="csv file of the results")
+    args = parser.parse_args()
+    main(args)
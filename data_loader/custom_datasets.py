@@ -1,15 +1,80 @@
 import torch
 import numpy as np
-from torch.utils.data import Dataset
-import glob as glob
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+import io
+import json
 import os
+import random
+import tarfile
 from PIL import Image
+from torchvision.io import ImageReadMode, decode_jpeg, read_file
+from utils.file_index import list_files
+
+try:
+    from turbojpeg import TJPF_RGB, TurboJPEG
+except ImportError:
+    # PyTurboJPEG is optional, only needed by the turbojpeg decode backend
+    TurboJPEG = None
+
+DECODE_BACKENDS = ('pil', 'pil-draft', 'turbojpeg', 'torchvision')
+
+
+class ImageDecoder:
+    """Opens image files as PIL images for the transforms of the image folder datasets.
+
+    pil decodes at full scale, like Image.open (and is faster with pillow-simd installed in place of Pillow).
+    pil-draft and turbojpeg decode JPEGs at the smallest DCT scale (1/2, 1/4 or 1/8) that still leaves both sides at
+    least `size` px, so for 64px training images most of the decoding of CelebA's 178x218 sources is skipped; the
+    output of the resize that follows is close to, but not bit-identical with, a full-scale decode. torchvision
+    decodes at full scale with torchvision.io.decode_jpeg. auto is turbojpeg if PyTurboJPEG is installed, else
+    pil-draft. Files that are not JPEGs are always opened with PIL.
+    """
+    def __init__(self, backend='pil', size=None):
+        if backend == 'auto':
+            backend = 'turbojpeg' if TurboJPEG is not None else 'pil-draft'
+        if backend not in DECODE_BACKENDS:
+            raise ValueError("Unknown decode backend {}, choose from {}".format(backend, DECODE_BACKENDS))
+        if backend == 'turbojpeg' and TurboJPEG is None:
+            raise ImportError("The turbojpeg decode backend needs PyTurboJPEG: pip install PyTurboJPEG")
+        if backend in ('pil-draft', 'turbojpeg') and size is None:
+            raise ValueError("The {} decode backend needs the size of the training images".format(backend))
+        self.backend = backend
+        self.size = size
+        self._turbo = None
+
+    def __getstate__(self):
+        # the libjpeg-turbo handle cannot be pickled to spawned workers, each loads its own
+        return dict(self.__dict__, _turbo=None)
+
+    def __call__(self, path):
+        if self.backend == 'pil' or not path.lower().endswith(('.jpg', '.jpeg')):
+            return Image.open(path)
+        if self.backend == 'pil-draft':
+            img = Image.open(path)
+            img.draft('RGB', (self.size, self.size))
+            return img
+        if self.backend == 'torchvision':
+            img = decode_jpeg(read_file(path), mode=ImageReadMode.RGB)
+            return Image.fromarray(img.permute(1, 2, 0).numpy())
+
+        if self._turbo is None:
+            self._turbo = TurboJPEG()
+        with open(path, 'rb') as f:
+            data = f.read()
+        width, height = self._turbo.decode_header(data)[:2]
+        scales = [(num, denom) for num, denom in self._turbo.scaling_factors
+                  if min(width, height) * num >= self.size * denom]
+        scale = min(scales, key=lambda s: s[0] / s[1], default=(1, 1))
+        return Image.fromarray(self._turbo.decode(data, pixel_format=TJPF_RGB, scaling_factor=scale))
+
 
 class CelebA64(Dataset):
-    def __init__(self, data_dir, transform):
+    def __init__(self, data_dir, transform, decoder=None):
         self.data_dir = data_dir
         self.transform = transform
-        self.img_paths = glob.glob(os.path.join(self.data_dir, "*.jpg"))
+        # see ImageDecoder
+        self.decoder = decoder if decoder is not None else ImageDecoder()
+        self.img_paths = list_files(self.data_dir, extensions=("jpg",))
         self.len = len(self.img_paths)
         self.img_paths = self.img_paths[:self.len]
 
@@ -18,7 +83,7 @@ class CelebA64(Dataset):
     
     def __getitem__(self, index):
         # print("hello", len(self.img_paths), index)
-        img = Image.open(self.img_paths[index])
+        img = self.decoder(self.img_paths[index])
 
         if self.transform:
             img = self.transform(img)
@@ -28,7 +93,7 @@ class FFHQ(Dataset):
     def __init__(self, data_dir, transform):
         self.data_dir = data_dir
         self.transform = transform
-        self.img_paths = glob.glob(os.path.join(self.data_dir, "*.png"))
+        self.img_paths = list_files(self.data_dir, extensions=("png",))
         self.len = len(self.img_paths)
         self.img_paths = self.img_paths[:self.len]
 
@@ -40,4 +105,139 @@ class FFHQ(Dataset):
 
         if self.transform:
             img = self.transform(img)
-        return (img, 1)
\ No newline at end of file
+        return (img, 1)
+
+
+class MemmapImageDataset(Dataset):
+    """Images packed by `pack_dataset.py` into one (N, C, H, W) uint8 .npy file.
+
+    The file is memory-mapped, so samples are read straight from the page cache without decoding. Items are uint8
+    tensors viewing the mapped memory, and `transform` has to work on tensors.
+    """
+    def __init__(self, packed_path, transform=None):
+        self.packed_path = packed_path
+        self.transform = transform
+        self.images = None
+        self.len, _, self.img_size, _ = np.load(packed_path, mmap_mode='r').shape
+
+    def __len__(self):
+        return self.len
+
+    def __getitem__(self, index):
+        if self.images is None:
+            # mapped lazily so that every dataloader worker maps the file itself; copy-on-write keeps the view
+            # writable for torch without copying
+            self.images = np.load(self.packed_path, mmap_mode='c')
+        img = torch.from_numpy(self.images[index])
+
+        if self.transform:
+            img = self.transform(img)
+        return (img, 1)
+
+
+class TarShardDataset(IterableDataset):
+    """Streams images from the tar shards written by `pack_dataset.py -f tar`.
+
+    Shards are read sequentially and split between dataloader workers (or, with fewer shards than workers, every
+    worker reads all shards and keeps every num_workers-th image). Samples pass through a shuffle buffer of
+    `shuffle_buffer` images. The stream of each worker only depends on `seed` and the epoch.
+
+    The position is tracked per worker stream: `BaseDataLoader` tags every batch with the worker that produced it
+    and calls `advance`. Once a worker runs out, the data loader stops taking batches in turn from all workers, so
+    a single count of images consumed could not be mapped back to the workers' streams. A position saved with
+    `state_dict` is resumed exactly with `load_state_dict` and the same `num_workers`; each worker skips the images
+    it had already delivered. The batches of different workers can then be interleaved in another order.
+    """
+    def __init__(self, shard_dir, transform, shuffle=True, shuffle_buffer=1000, seed=0, num_workers=0):
+        self.shard_dir = shard_dir
+        self.transform = transform
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        with open(os.path.join(shard_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.shards = [os.path.join(shard_dir, shard['name']) for shard in index['shards']]
+        self.len = sum(shard['count'] for shard in index['shards'])
+        self.epoch = 0
+        # images of the current epoch consumed from the stream of each worker (one stream without workers)
+        self.worker_consumed = [0] * max(num_workers, 1)
+
+    def __len__(self):
+        return self.len
+
+    @property
+    def consumed(self):
+        return sum(self.worker_consumed)
+
+    def advance(self, n, worker_id=0):
+        """Records that n images of the stream of worker `worker_id` were used"""
+        self.worker_consumed[worker_id] += n
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.worker_consumed = [0] * len(self.worker_consumed)
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'consumed': self.consumed, 'worker_consumed': list(self.worker_consumed)}
+
+    def load_state_dict(self, state_dict):
+        worker_consumed = state_dict.get('worker_consumed')
+        if worker_consumed is None:
+            # positions saved before they were tracked per worker cannot be mapped to the streams, restart the epoch
+            self.set_epoch(state_dict['epoch'])
+            return
+        if len(worker_consumed) != len(self.worker_consumed):
+            raise ValueError("The stream position was saved with {} workers, but the data loader has {}; resume "
+                             "with the same num_workers".format(len(worker_consumed), len(self.worker_consumed)))
+        self.epoch = state_dict['epoch']
+        self.worker_consumed = list(worker_consumed)
+
+    def _records(self, shards, stride, offset):
+        """(name, bytes) of every stride-th file of the shards, starting at offset"""
+        i = 0
+        for shard in shards:
+            with tarfile.open(shard, 'r|') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    if i % stride == offset:
+                        yield member.name, tar.extractfile(member).read()
+                    i += 1
+
+    def _shuffled(self, records, rng):
+        buffer = []
+        for record in records:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+            j = rng.randrange(len(buffer))
+            yield buffer[j]
+            buffer[j] = record
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        assert num_workers == len(self.worker_consumed), \
+            "the dataset tracks {} worker streams, but is read by {}".format(len(self.worker_consumed), num_workers)
+
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random('{}:{}'.format(self.seed, self.epoch)).shuffle(shards)
+        if len(shards) >= num_workers:
+            records = self._records(shards[worker_id::num_workers], 1, 0)
+        else:
+            records = self._records(shards, num_workers, worker_id)
+        if self.shuffle:
+            records = self._shuffled(records, random.Random('{}:{}:{}'.format(self.seed, self.epoch, worker_id)))
+
+        skip = self.worker_consumed[worker_id]
+        for i, (_, data) in enumerate(records):
+            if i < skip:
+                continue
+            img = Image.open(io.BytesIO(data))
+            if self.transform:
+                img = self.transform(img)
+            yield (img, 1)
+
@@ -1,57 +1,163 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
 from torchvision import datasets, transforms
-from base import BaseDataLoader
+from base import BaseDataLoader, BaseGPUDataLoader
 from data_loader.custom_datasets import *
+from utils.util import crop_image_by_part
 
 class MnistDataLoader(BaseDataLoader):
     """
     MNIST data loading demo using BaseDataLoader
     """
     def __init__(self, data_dir, batch_size, shuffle=True, train_portion=1.0, num_workers=1, pin_memory=False,
-                 drop_last=False, training=True):
+                 drop_last=False, training=True, uint8=False):
         trsfm = transforms.Compose([
             transforms.Resize(28),
-            transforms.ToTensor(),
-            transforms.Normalize([0.5], [0.5])
+            *_to_tensor(uint8, n_channels=1)
         ])
         self.data_dir = data_dir
         self.dataset = datasets.MNIST(self.data_dir, train=training, download=True, transform=trsfm)
-        super().__init__(self.dataset, batch_size, shuffle, train_portion, num_workers, pin_memory=pin_memory, drop_last=drop_last)
+        super().__init__(self.dataset, batch_size, shuffle, train_portion, num_workers, pin_memory=pin_memory, drop_last=drop_last,
+                         uint8=uint8)
+
+def _to_tensor(uint8, n_channels=3):
+    """Last transforms of the image folder pipelines: uint8 tensors to be normalized per batch on the device, or
+    normalized float tensors"""
+    if uint8:
+        return [transforms.PILToTensor()]
+    return [transforms.ToTensor(), transforms.Normalize((0.5,) * n_channels, (0.5,) * n_channels)]
+
+def _packed_dataset(packed_path, img_size, augment=(), uint8=False):
+    """`MemmapImageDataset` of images packed by pack_dataset.py, normalized like the image folder pipelines"""
+    normalize = [] if uint8 else [
+                    transforms.ConvertImageDtype(torch.float),
+                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+                    ]
+    trsfm = transforms.Compose(list(augment) + normalize)
+    dataset = MemmapImageDataset(packed_path, transform=trsfm)
+    assert dataset.img_size == img_size, \
+        "{} is packed at {}px, but img_size is {}".format(packed_path, dataset.img_size, img_size)
+    return dataset
 
 class CelebA64DataLoader(BaseDataLoader):
-    def __init__(self, data_dir, batch_size, img_size=64, train_portion=0.9, shuffle=True, num_workers=1, pin_memory=False, drop_last=False, training=True):
+    def __init__(self, data_dir, batch_size, img_size=64, train_portion=0.9, shuffle=True, num_workers=1, pin_memory=False, drop_last=False, training=True,
+                 packed_path=None, uint8=False, decode='pil'):
         trsfm = transforms.Compose([
                         transforms.Resize(img_size),
                         transforms.CenterCrop(img_size),
-                        transforms.ToTensor(),
-                        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+                        *_to_tensor(uint8)
                         ])
         self.data_dir = data_dir
-        self.dataset = CelebA64(self.data_dir, transform=trsfm)
-        super().__init__(self.dataset, batch_size, shuffle, train_portion, num_workers, pin_memory=pin_memory, drop_last=drop_last)
+        if packed_path is not None:
+            self.dataset = _packed_dataset(packed_path, img_size, uint8=uint8)
+        else:
+            # decode: one of DECODE_BACKENDS or auto, see ImageDecoder
+            self.dataset = CelebA64(self.data_dir, transform=trsfm, decoder=ImageDecoder(decode, size=img_size))
+        super().__init__(self.dataset, batch_size, shuffle, train_portion, num_workers, pin_memory=pin_memory, drop_last=drop_last,
+                         uint8=uint8)
 
 class Cifar10DataLoader(BaseDataLoader):
-    def __init__(self, data_dir, batch_size, img_size=32, shuffle=True, train_portion=1.0, num_workers=1, pin_memory=False, drop_last=False, training=True):
+    def __init__(self, data_dir, batch_size, img_size=32, shuffle=True, train_portion=1.0, num_workers=1, pin_memory=False, drop_last=False, training=True,
+                 uint8=False):
         self.data_dir = data_dir
         trsfm = transforms.Compose([
                         transforms.Resize(img_size),
                         transforms.CenterCrop(img_size),
-                        transforms.ToTensor(),
-                        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+                        *_to_tensor(uint8)
                         ])
         self.dataset = datasets.CIFAR10(self.data_dir, transform=trsfm, download=True)
-        super().__init__(self.dataset, batch_size, shuffle, train_portion, num_workers, pin_memory=pin_memory, drop_last=drop_last)
+        super().__init__(self.dataset, batch_size, shuffle, train_portion, num_workers, pin_memory=pin_memory, drop_last=drop_last,
+                         uint8=uint8)
+
+
+class Cifar10GPUDataLoader(BaseGPUDataLoader):
+    """
+    CIFAR-10 kept on the device as uint8, see BaseGPUDataLoader. num_workers and pin_memory are accepted so configs
+    of Cifar10DataLoader can switch type without other changes, but are unused.
+    """
+    def __init__(self, data_dir, batch_size, img_size=32, shuffle=True, train_portion=1.0, num_workers=1, pin_memory=False, drop_last=False, training=True,
+                 flip=False, device=None):
+        self.data_dir = data_dir
+        self.dataset = datasets.CIFAR10(self.data_dir, train=training, download=True)
+        images = torch.from_numpy(self.dataset.data).permute(0, 3, 1, 2)
+        if img_size != images.shape[-1]:
+            images = _resize_uint8(images, img_size)
+        super().__init__(images, self.dataset.targets, batch_size, shuffle, train_portion, drop_last=drop_last,
+                         flip=flip, device=device)
+
+class CelebA64GPUDataLoader(BaseGPUDataLoader):
+    """
+    CelebA kept on the device as uint8, see BaseGPUDataLoader. The images are decoded and resized once at start-up
+    with num_workers processes and the `decode` backend (see ImageDecoder), or read from a file written by
+    pack_dataset.py if packed_path is given.
+    """
+    def __init__(self, data_dir, batch_size, img_size=64, train_portion=0.9, shuffle=True, num_workers=1, pin_memory=False, drop_last=False, training=True,
+                 packed_path=None, flip=False, device=None, decode='pil'):
+        self.data_dir = data_dir
+        if packed_path is not None:
+            images = torch.from_numpy(np.load(packed_path))
+            assert images.shape[-1] == img_size, \
+                "{} is packed at {}px, but img_size is {}".format(packed_path, images.shape[-1], img_size)
+        else:
+            trsfm = transforms.Compose([
+                            transforms.Resize(img_size),
+                            transforms.CenterCrop(img_size),
+                            transforms.PILToTensor()
+                            ])
+            dataset = CelebA64(self.data_dir, transform=trsfm, decoder=ImageDecoder(decode, size=img_size))
+            decode_loader = torch.utils.data.DataLoader(dataset, batch_size=256, num_workers=num_workers)
+            images = torch.cat([imgs for imgs, _ in decode_loader])
+        super().__init__(images, None, batch_size, shuffle, train_portion, drop_last=drop_last, flip=flip,
+                         device=device)
+
+def _resize_uint8(images, img_size):
+    """Resize (shorter side to img_size) and center crop of a uint8 image tensor, done once on upload"""
+    resized = transforms.Resize(img_size, antialias=True)(images.float())
+    return transforms.CenterCrop(img_size)(resized).round_().clamp_(0, 255).to(torch.uint8)
+
+
+class FastGANPyramidCollate:
+    """
+    Collates a batch and, in the loader workers, computes the downsampled real images FastGAN's discriminator and its
+    reconstruction losses use: the batch at `size` px and its four quarter crops, each resized to `size` px with the
+    same nearest interpolation as FastGANTrainer. They replace the labels, as [imgs_small, parts] with parts of shape
+    (B, 4, C, size, size).
+    """
+    def __init__(self, size=128):
+        self.size = size
+
+    def __call__(self, batch):
+        imgs, _ = default_collate(batch)
+        imgs_small = F.interpolate(imgs, size=self.size)
+        parts = torch.stack([F.interpolate(crop_image_by_part(imgs, part), size=self.size) for part in range(4)], 1)
+        return imgs, [imgs_small, parts]
 
 
 class HighResolutionDataLoader(BaseDataLoader):
-    def __init__(self, data_dir, batch_size, img_size=512, shuffle=True, train_portion=1.0, num_workers=1, pin_memory=False, drop_last=False, training=True):
+    def __init__(self, data_dir, batch_size, img_size=512, shuffle=True, train_portion=1.0, num_workers=1, pin_memory=False, drop_last=False, training=True,
+                 packed_path=None, uint8=False, shard_dir=None, shuffle_buffer=1000, pyramid=False):
         transform_list = [
             transforms.Resize((int(img_size), int(img_size))),
             transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
+            *_to_tensor(uint8)
         ]
         transf = transforms.Compose(transform_list)
         self.data_dir = data_dir
-        self.dataset = FFHQ(self.data_dir, transform=transf)
-        super().__init__(self.dataset, batch_size, shuffle, train_portion, num_workers, pin_memory=pin_memory,
-                         drop_last=drop_last)
+        self.stream = None
+        if shard_dir is not None:
+            # sequential reads of tar shards; shuffling is done by the dataset's shuffle buffer, and the position in
+            # each worker's stream is tracked by BaseDataLoader
+            self.stream = TarShardDataset(shard_dir, transform=transf, shuffle=shuffle, shuffle_buffer=shuffle_buffer,
+                                          num_workers=num_workers)
+            self.dataset = self.stream
+            shuffle = False
+        elif packed_path is not None:
+            self.dataset = _packed_dataset(packed_path, img_size, augment=[transforms.RandomHorizontalFlip()],
+                                           uint8=uint8)
+        else:
+            self.dataset = FFHQ(self.data_dir, transform=transf)
+        # with pyramid set, FastGAN's downsampled real images are computed by the workers, see FastGANPyramidCollate
+        collate_fn = FastGANPyramidCollate() if pyramid else default_collate
+        super().__init__(self.dataset, batch_size, shuffle, train_portion, num_workers, collate_fn=collate_fn,
+                         pin_memory=pin_memory, drop_last=drop_last, uint8=uint8)
@@ -1,13 +1,11 @@
 """This module is fol calculation of datasets' statistics for FID evaluation"""
 
-from utils.fid_score import calculate_activation_statistics
+from utils.fid_score import compute_statistics_of_path
+from utils.file_index import load_file_index
 from argparse import ArgumentParser
 import numpy as np
 from utils.inception_score import InceptionV3
 import torch
-import os
-import glob
-from operator import itemgetter
 
 
 def main(args):
@@ -16,20 +14,15 @@ def main(args):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     model = InceptionV3([block_idx]).to(device)
-    paths = glob.glob(os.path.join(args.path, "*.png"))
-    if len(paths) == 0:
-        paths = glob.glob(os.path.join(args.path, "*.jpg"))
-    
-    idx_full = np.arange(len(paths))
-    np.random.seed(0)
-    np.random.shuffle(idx_full)
-    idx_calc = idx_full[:int(len(paths)*args.portion)]
-    # print(idx_calc, type(idx_calc), list(idx_calc))
-    paths = itemgetter(*list(idx_calc))(paths)
-    
-    assert len(paths) !=0
-    
-    mu, sigma = calculate_activation_statistics(paths, model, device=device)
+
+    if args.refresh_index:
+        # rescan the data dir, e.g. after images were replaced in place
+        load_file_index(args.path, refresh=True)
+
+    # statistics are also stored in the FID statistics cache, so eval.py finds them
+    # without -cs as long as it is pointed at the same data dir and portion
+    mu, sigma = compute_statistics_of_path(args.path, model, batch_size=50, dims=2048, device=device,
+                                           portion=args.portion)
     
     # os.makedirs(save_path, exist_ok=True)
     np.savez(f"{args.dataset_name}.npz", mu=mu, sigma=sigma)
@@ -39,6 +32,8 @@ if __name__ == "__main__":
     parser.add_argument("-nm", "--dataset_name", default=None, type=str, help="name of the current dataset")
     parser.add_argument("-p", "--path", default=None, type=str, help="path to dataset dir")
     parser.add_argument("-pr", "--portion", default=1.0, type=float, help="portion of training data for calculating stats")
+    parser.add_argument("-ri", "--refresh_index", default=False, action="store_true",
+                        help="rebuild the cached file index of the data dir instead of reusing it")
     # parser.add_argument("-sp", "--save_path", default=None, type=str, help="path for saving statistics")
     args = parser.parse_args()
     main(args)
\ No newline at end of file
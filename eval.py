@@ -2,16 +2,19 @@ import argparse
 import collections
 import torch
 import torch.nn.functional as F
-from torchvision import utils as vutils
 from tqdm import tqdm
 import model.models as module_arch
 from parse_config import ConfigParser
 import glob
 from utils.fid_score import *
+from utils.fid_evaluator import FIDEvaluator
+from utils.latent_bank import LatentBank, shard_range
+from utils.image_writer import ImageWriterPool, IMAGE_FORMATS
+from utils.memory import MemoryPolicy
+from utils.metrics import MetricsEngine
 import shutil
 import os
 import csv
-import gc
 
 # def resize(img):
 #     return F.interpolate(img, size=256)
@@ -32,6 +35,53 @@ import gc
 #         vutils.save_image(image.add(1).mul(0.5), f'{folder_name}/{i}.jpg')
 
 
+def _log_fid(model_name, fid_value, ckpt):
+    print(fid_value, ckpt)
+    with open(f"./{model_name}-fid.csv", "a") as f:
+        writer = csv.writer(f)
+        writer.writerow([fid_value, ckpt.split("/")[-1].split(".")[0]])
+
+
+def _log_metrics(model_name, results, ckpt):
+    print(results, ckpt)
+    path = f"./{model_name}-metrics.csv"
+    write_header = not os.path.exists(path)
+    with open(path, "a") as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(list(results.keys()) + ['checkpoint'])
+        writer.writerow(list(results.values()) + [ckpt.split("/")[-1].split(".")[0]])
+
+
+def _shard_stats_path(ckpt, seed, n_sample, shard_index, num_shards):
+    return '{}.stats-seed{}-n{}-{}of{}.pt'.format(os.path.splitext(ckpt)[0], seed, n_sample, shard_index, num_shards)
+
+
+def _evaluate_sharded(evaluator, model, ckpts, args, n_sample, model_name):
+    """Each shard accumulates inception statistics of its slice of the latent bank and saves them next to the
+    checkpoint; `--merge_shards` combines all slices into the exact full-run FID."""
+    for ckpt in ckpts:
+        if args.merge_shards:
+            stats = ActivationStatistics(evaluator.dims, evaluator.device)
+            for shard_index in range(args.num_shards):
+                shard_path = _shard_stats_path(ckpt, args.seed, n_sample, shard_index, args.num_shards)
+                if not os.path.exists(shard_path):
+                    raise FileNotFoundError('Missing shard statistics: {}'.format(shard_path))
+                shard = ActivationStatistics(evaluator.dims)
+                shard.load_state_dict(torch.load(shard_path))
+                stats.merge(shard)
+            _log_fid(model_name, evaluator.score_statistics(stats), ckpt)
+            continue
+
+        checkpoint = torch.load(ckpt, map_location='cpu')
+        model.load_state_dict(checkpoint['state_dict'])
+        del checkpoint
+        model.to(evaluator.device)
+        start, stop = shard_range(n_sample, args.shard_index, args.num_shards)
+        stats = evaluator.accumulate_generator(model.generator, model.latent_dim, start, stop)
+        torch.save(stats.state_dict(), _shard_stats_path(ckpt, args.seed, n_sample, args.shard_index, args.num_shards))
+
+
 def main(config: ConfigParser, args):
     logger = config.get_logger('test')
 
@@ -41,49 +91,91 @@ def main(config: ConfigParser, args):
     model_name = config['name']
     logger.info(model)
     
+    # without precalculated stats, fall back to the training images; their statistics are
+    # computed once and then served from the FID statistics cache
+    ref_path = args.calculated_stats
+    if ref_path == "None":
+        ref_path = config['data_loader']['args']['data_dir']
+
     ckpts = glob.glob(os.path.join(resume, "*.pth"))
     # print(glob.glob("checkpoints/*.pth"))
     ckpts.sort()
+
+    # prepare model for testing
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if config['n_gpu'] > 1:
+        model.DataParallel()
+    model.to(device)
+    latent_dim = model.latent_dim
+
+    # inception and the reference statistics are built once for all checkpoints
+    metrics = args.metrics.split(',')
+    if metrics == ['fid']:
+        evaluator = FIDEvaluator(ref_path, batch_size=config['eval']['batch_size'], device=device, dims=2048,
+                                 num_workers=1, portion=args.portion, sqrtm_method=args.sqrtm,
+                                 seed=args.seed, feature_cache=args.feature_cache)
+        log_result = _log_fid
+    else:
+        # all metrics are derived from one inception pass over the generated images
+        evaluator = MetricsEngine(ref_path, batch_size=config['eval']['batch_size'], device=device,
+                                  metrics=metrics, num_workers=1, portion=args.portion, sqrtm_method=args.sqrtm,
+                                  seed=args.seed, feature_cache=args.feature_cache)
+        log_result = _log_metrics
+
+    if args.num_shards > 1:
+        assert metrics == ['fid'], 'Sharded evaluation only supports fid'
+        _evaluate_sharded(evaluator, model, ckpts, args, config['eval']['n_sample'], model_name)
+        return
+
+    if args.in_memory:
+        # score generated images directly, without a round trip through disk. The next checkpoint is
+        # loaded while the current one is scored.
+        for i, (ckpt, result) in enumerate(evaluator.evaluate(model, ckpts, config['eval']['n_sample'])):
+            log_result(model_name, result, ckpt)
+            if args.clear_dir and i != len(ckpts)-1:
+                os.remove(ckpt)
+        return
+
     os.makedirs(config['eval']['save_dir'], exist_ok=True)
+    n_sample, batch_size = config['eval']['n_sample'], config['eval']['batch_size']
+    # images of earlier runs, in another format or of more samples, must not be scored with this run's
+    run_dir = os.path.join(config['eval']['save_dir'], '{}-seed{}-n{}'.format(args.image_format, args.seed, n_sample))
+    memory = MemoryPolicy(device=device, **config['eval'].get('memory', {}))
+    memory.freeze()
     for i, ckpt in enumerate(ckpts):
-        logger.info('Loading checkpoint: {} ...'.format(resume))
-        checkpoint = torch.load(ckpt)
-        state_dict = checkpoint['state_dict']
-        if config['n_gpu'] > 1:
-            model.DataParallel()
-        model.load_state_dict(state_dict)
-
-        # prepare model for testing
-        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        model.to(device)
+        logger.info('Loading checkpoint: {} ...'.format(ckpt))
+        checkpoint = torch.load(ckpt, map_location=device)
+        model.load_state_dict(checkpoint['state_dict'])
+        del checkpoint
         model.generator.eval()
 
-        latent_dim = model.latent_dim
-
-        # generate images
-        with torch.no_grad():
-            for i in tqdm(range(config['eval']['n_sample']//config['eval']['batch_size'])):
-                noise = torch.randn(config['eval']['batch_size'], latent_dim).to(device)
+        # generate images; every checkpoint sees the same latents, whatever the batch size. Encoding and writing
+        # happen in the writer pool, so the generator only waits when the writers fall behind.
+        bank = LatentBank(args.seed, latent_dim)
+        if os.path.isdir(run_dir):
+            shutil.rmtree(run_dir)
+        with torch.no_grad(), ImageWriterPool(run_dir, fmt=args.image_format,
+                                              compress_level=args.compress_level,
+                                              num_workers=args.writers) as writer:
+            for batch_idx, noise in enumerate(tqdm(bank.batches(0, n_sample, batch_size),
+                                                   total=-(-n_sample // batch_size))):
+                noise = noise.to(device)
                 generated_imgs = model.generator(noise)
                 if len(generated_imgs) > 1 and generated_imgs[0].size() != generated_imgs[1].size():
                     generated_imgs = generated_imgs[0]
-                for j, g_img in enumerate(generated_imgs):
-                    vutils.save_image(g_img.add(1).mul(0.5), 
-                        os.path.join(config['eval']['save_dir'], '%d.png'%(i*config['eval']['batch_size']+j)))#, normalize=True, range=(-1,1))
+                writer.put(generated_imgs, batch_idx * batch_size)
                 del generated_imgs
-                gc.collect()
+                memory.step()
+        logger.info('Generation memory: {}'.format(memory.stats()))
 
-        fid_value = calculate_fid_given_paths((config['eval']['save_dir'], args.calculated_stats), batch_size=config['eval']['batch_size'], device=device, dims=2048, num_workers=1)
+        result = evaluator.score_path(run_dir)
 
-        print(fid_value, ckpt)
-        with open(f"./{model_name}-fid.csv", "a") as f:
-            writer = csv.writer(f)
-            writer.writerow([fid_value, ckpt.split("/")[-1].split(".")[0]])  
+        log_result(model_name, result, ckpt)
 
         if args.clear_dir and i != len(ckpts)-1:
             os.remove(ckpt)
 
-    if args.clear_generated:
+    if args.clear_generated and os.path.isdir(config['eval']['save_dir']):
         shutil.rmtree(config['eval']['save_dir'])
 
 
@@ -97,11 +189,35 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--device', default=None, type=str,
                       help='indices of GPUs to enable (default: all)')
     parser.add_argument('-cs', '--calculated_stats', default="None", type=str,
-                        help="path to precalculated stats")
+                        help="path to precalculated stats (default: statistics of the config's data_dir, cached)")
+    parser.add_argument('-pr', '--portion', default=1.0, type=float,
+                        help="portion of the reference images used when stats are computed from a directory")
+    parser.add_argument('-sq', '--sqrtm', default="scipy", type=str, choices=SQRTM_METHODS,
+                        help="matrix square root used for the FID; eigh and newton_schulz are much faster")
+    parser.add_argument('-m', '--metrics', default="fid", type=str,
+                        help="comma separated metrics out of fid,kid,is,prdc, computed from one inception pass")
+    parser.add_argument('-s', '--seed', default=0, type=int,
+                        help="seed of the latent bank the generator noise is taken from")
+    parser.add_argument('-fc', '--feature_cache', default=False, action="store_true",
+                        help="in in-memory mode, store generated features next to each checkpoint and reuse them")
+    parser.add_argument('-fmt', "--image_format", default="png", type=str, choices=IMAGE_FORMATS,
+                        help="format of the images generated on disk; npy stores uncompressed uint8 shards")
+    parser.add_argument('-cl', "--compress_level", default=1, type=int,
+                        help="png compression level (webp lossless method) of the generated images")
+    parser.add_argument('-w', "--writers", default=4, type=int,
+                        help="number of threads encoding and writing generated images")
     parser.add_argument('-clr', "--clear_dir", default=False, action="store_true",
                         help="whether or not cleaning the whole model's checkpoints dir except for the lastest checkpoint after calculation")
     parser.add_argument('-cgm', "--clear_generated", default=False, action="store_true",
                         help="whether or not cleaning the generated images after calculation")
+    parser.add_argument('-ns', "--num_shards", default=1, type=int,
+                        help="split the generated samples over this many processes; each saves partial statistics")
+    parser.add_argument('-si', "--shard_index", default=0, type=int,
+                        help="index of the shard this process scores, in [0, num_shards)")
+    parser.add_argument('-ms', "--merge_shards", default=False, action="store_true",
+                        help="merge the statistics saved by all shards and log the FID of each checkpoint")
+    parser.add_argument('-im', "--in_memory", default=False, action="store_true",
+                        help="feed generated images straight into inception instead of saving them to disk")
     args = parser.parse_args()
     # custom cli options to modify configuration from default values given in json file.
     CustomArgs = collections.namedtuple('CustomArgs', 'flags type target')
@@ -101,6 +101,13 @@ class Wandb():
                                  config=visualize_config,
                                  )
 
+        # wandb drops values logged at a step lower than one it has seen, but metrics are written after later steps
+        # were set (see MetricTracker). So rows are logged without a wandb step and carry the writer step in the
+        # 'step' field instead, which is made the x-axis of every metric.
+        if self.writer is not None and hasattr(self.writer, 'define_metric'):
+            self.writer.define_metric('step')
+            self.writer.define_metric('*', step_metric='step')
+
         self.step = 0
         self.mode = ''
 
@@ -129,6 +136,7 @@ class Wandb():
             if add_data is not None:
                 # add mode(train/valid) tag
                 tag = '{}/{}'.format(list(data.keys())[0], self.mode)
-                add_data({tag: data[list(data.keys())[0]]}, self.step if step is not None else step, *args, **kwargs)
+                # the writer step goes in the row, not to wandb's step, see __init__; step is kept for compatibility
+                add_data({tag: data[list(data.keys())[0]], 'step': self.step}, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,102 @@
+"""This module packs an image directory into a pre-decoded uint8 array for `MemmapImageDataset`, or into tar shards
+for `TarShardDataset`"""
+
+import glob
+import json
+import os
+import tarfile
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+from torchvision import transforms
+
+RESIZE_MODES = ('center_crop', 'stretch')
+
+
+def _resize_transform(img_size, resize):
+    # the same geometry as CelebA64DataLoader (center_crop) and HighResolutionDataLoader (stretch)
+    if resize == 'center_crop':
+        return transforms.Compose([transforms.Resize(img_size), transforms.CenterCrop(img_size)])
+    return transforms.Resize((img_size, img_size))
+
+
+def _load_resized(args):
+    path, img_size, resize = args
+    img = _resize_transform(img_size, resize)(Image.open(path).convert('RGB'))
+    return np.asarray(img, dtype=np.uint8).transpose(2, 0, 1)
+
+
+def pack(data_dir, out_path, img_size, resize='center_crop', pattern='*.jpg', num_workers=4):
+    """Writes the images in `data_dir` matching `pattern`, resized to img_size, into `out_path` as one (N, 3, H, W)
+    uint8 .npy array, and their file names into a json index next to it"""
+    assert out_path.endswith('.npy'), 'The packed dataset must be a .npy file'
+    paths = sorted(glob.glob(os.path.join(data_dir, pattern)))
+    if len(paths) == 0:
+        raise RuntimeError('No images matching {} found in: {}'.format(pattern, data_dir))
+
+    tmp_path = out_path + '.tmp.%d.npy' % os.getpid()
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(paths), 3, img_size, img_size))
+    with Pool(num_workers) as pool:
+        jobs = ((path, img_size, resize) for path in paths)
+        for i, img in enumerate(pool.imap(_load_resized, jobs, chunksize=64)):
+            out[i] = img
+    out.flush()
+    del out
+    os.replace(tmp_path, out_path)
+
+    index = {'data_dir': os.path.abspath(data_dir), 'img_size': img_size, 'resize': resize,
+             'files': [os.path.basename(path) for path in paths]}
+    with open(index_path(out_path), 'w') as f:
+        json.dump(index, f)
+
+
+def pack_shards(data_dir, out_dir, pattern='*.png', shard_size=1000):
+    """Writes the images in `data_dir` matching `pattern`, still encoded, into tar shards of `shard_size` images in
+    `out_dir`, with an index.json of the shards and their image counts"""
+    paths = sorted(glob.glob(os.path.join(data_dir, pattern)))
+    if len(paths) == 0:
+        raise RuntimeError('No images matching {} found in: {}'.format(pattern, data_dir))
+    os.makedirs(out_dir, exist_ok=True)
+
+    shards = []
+    for shard_idx, start in enumerate(range(0, len(paths), shard_size)):
+        name = 'shard-%06d.tar' % shard_idx
+        tmp_path = os.path.join(out_dir, name + '.tmp.%d' % os.getpid())
+        with tarfile.open(tmp_path, 'w') as tar:
+            for path in paths[start:start + shard_size]:
+                tar.add(path, arcname=os.path.basename(path))
+        os.replace(tmp_path, os.path.join(out_dir, name))
+        shards.append({'name': name, 'count': len(paths[start:start + shard_size])})
+
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump({'data_dir': os.path.abspath(data_dir), 'shards': shards}, f)
+
+
+def index_path(packed_path):
+    return packed_path[:-len('.npy')] + '.json'
+
+
+def main(args):
+    if args.format == 'tar':
+        pack_shards(args.path, args.output, args.pattern, args.shard_size)
+    else:
+        pack(args.path, args.output, args.img_size, args.resize, args.pattern, args.num_workers)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-p", "--path", default=None, type=str, help="path to dataset dir")
+    parser.add_argument("-o", "--output", default=None, type=str,
+                        help="path of the packed .npy file, or directory of the tar shards")
+    parser.add_argument("-f", "--format", default="npy", type=str, choices=["npy", "tar"],
+                        help="npy: pre-decoded and resized uint8 array, tar: shards of the encoded source files")
+    parser.add_argument("-ss", "--shard_size", default=1000, type=int, help="number of images per tar shard")
+    parser.add_argument("-s", "--img_size", default=64, type=int, help="side length of the packed images")
+    parser.add_argument("-r", "--resize", default="center_crop", type=str, choices=RESIZE_MODES,
+                        help="center_crop as for CelebA64, stretch as for FFHQ")
+    parser.add_argument("-pt", "--pattern", default="*.jpg", type=str, help="glob pattern of the images to pack")
+    parser.add_argument("-w", "--num_workers", default=4, type=int, help="number of decoding processes")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,70 @@
+import sys
+import types
+
+import pytest
+import torch
+
+from logger.visualization import Wandb
+from utils.util import MetricTracker
+
+
+class StubRun:
+    """wandb run that, like wandb, drops values logged at a step lower than the current one"""
+    def __init__(self):
+        self.step = 0
+        self.rows = []
+        self.step_metrics = {}
+
+    def define_metric(self, name, step_metric=None):
+        self.step_metrics[name] = step_metric
+
+    def log(self, data, step=None, commit=None):
+        if step is not None:
+            if step < self.step:
+                return
+            self.step = step
+        self.rows.append(dict(data))
+
+
+@pytest.fixture
+def wandb_writer(tmp_path, monkeypatch):
+    run = StubRun()
+    monkeypatch.setitem(sys.modules, 'stub_wandb', types.SimpleNamespace(init=lambda **kwargs: run))
+    key_file = tmp_path / 'key'
+    key_file.write_text('key')
+    cfg_trainer = {'api_key_file': str(key_file), 'project': 'test', 'entity': 'test'}
+    return Wandb('test', cfg_trainer, None, 'stub_wandb'), run
+
+
+@pytest.mark.parametrize('deferred, flush_interval', [(False, 1), (False, 7), (True, 1), (True, 7)])
+def test_every_value_reaches_wandb(wandb_writer, deferred, flush_interval):
+    writer, run = wandb_writer
+    tracker = MetricTracker('g_loss', 'p', writer=writer, deferred=deferred, flush_interval=flush_interval)
+    p = torch.zeros([])
+    for step in range(1, 31):
+        writer.set_step(step)
+        tracker.update('g_loss', torch.tensor(float(step)))
+        # updated in place like ADA's p
+        p.copy_(torch.tensor(step / 100.))
+        tracker.update('p', p)
+        if step % 4 == 0:
+            tracker.sync()
+    tracker.result()
+
+    logged = {(key, row['step']): value for row in run.rows for key, value in row.items() if key != 'step'}
+    for step in range(1, 31):
+        assert logged[('g_loss/train', step)] == step
+        assert logged[('p/train', step)] == pytest.approx(step / 100.)
+    assert run.step_metrics['*'] == 'step'
+
+
+def test_averages_match_eager(wandb_writer):
+    writer, _ = wandb_writer
+    eager = MetricTracker('d_loss', writer=writer)
+    deferred = MetricTracker('d_loss', writer=writer, deferred=True, flush_interval=5)
+    for value in (0.5, 1.0, 2.5):
+        eager.update('d_loss', torch.tensor(value), n=2)
+        deferred.update('d_loss', torch.tensor(value), n=2)
+    assert deferred.avg('d_loss') == pytest.approx(eager.avg('d_loss'))
+    deferred.reset()
+    assert deferred.result()['d_loss'] == 0
@@ -0,0 +1,34 @@
+from copy import deepcopy
+
+import pytest
+import torch
+from torch.utils.data import Dataset
+
+from base.base_data_loader import BaseDataLoader
+
+N_SAMPLES, BATCH_SIZE = 39, 4
+
+
+class IndexDataset(Dataset):
+    def __len__(self):
+        return N_SAMPLES
+
+    def __getitem__(self, index):
+        return torch.tensor(index), 1
+
+
+@pytest.mark.parametrize('num_workers', [0, 2, 3])
+def test_resume_continues_with_the_next_batches(num_workers):
+    # map-style batches come back in the order of the sampler whatever the worker, so one count is the position
+    loader = BaseDataLoader(IndexDataset(), BATCH_SIZE, True, 1.0, num_workers)
+    batches, states = [], []
+    for imgs, _ in loader:
+        batches.append(imgs.tolist())
+        states.append(deepcopy(loader.state_dict()))
+    assert sorted(sum(batches, [])) == list(range(N_SAMPLES))
+    assert loader.state_dict() == {'epoch': 1, 'consumed': 0}
+
+    for k, state in enumerate(states[:-1]):
+        resumed = BaseDataLoader(IndexDataset(), BATCH_SIZE, True, 1.0, num_workers)
+        resumed.load_state_dict(state)
+        assert [imgs.tolist() for imgs, _ in resumed] == batches[k + 1:], 'resumed after batch {}'.format(k)
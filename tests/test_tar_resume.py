@@ -0,0 +1,69 @@
+import io
+import json
+import tarfile
+from collections import Counter
+from copy import deepcopy
+
+import pytest
+from PIL import Image
+
+from base.base_data_loader import BaseDataLoader
+from data_loader.custom_datasets import TarShardDataset
+
+N_IMAGES, SHARD_SIZE, BATCH_SIZE = 39, 7, 4
+
+
+def _pixel(img):
+    """the index an image was written with"""
+    return img.getpixel((0, 0))
+
+
+@pytest.fixture(scope='module')
+def shard_dir(tmp_path_factory):
+    out_dir = tmp_path_factory.mktemp('shards')
+    shards = []
+    for start in range(0, N_IMAGES, SHARD_SIZE):
+        name = 'shard-%06d.tar' % len(shards)
+        with tarfile.open(str(out_dir / name), 'w') as tar:
+            for i in range(start, min(start + SHARD_SIZE, N_IMAGES)):
+                buf = io.BytesIO()
+                Image.new('L', (1, 1), i).save(buf, format='PNG')
+                info = tarfile.TarInfo('%06d.png' % i)
+                info.size = buf.tell()
+                buf.seek(0)
+                tar.addfile(info, buf)
+        shards.append({'name': name, 'count': min(SHARD_SIZE, N_IMAGES - start)})
+    with open(str(out_dir / 'index.json'), 'w') as f:
+        json.dump({'data_dir': str(out_dir), 'shards': shards}, f)
+    return str(out_dir)
+
+
+def _loader(shard_dir, num_workers):
+    dataset = TarShardDataset(shard_dir, transform=_pixel, shuffle_buffer=5, num_workers=num_workers)
+    return BaseDataLoader(dataset, BATCH_SIZE, False, 1.0, num_workers)
+
+
+@pytest.mark.parametrize('num_workers', [0, 2, 3])
+def test_resume_continues_with_the_rest_of_the_epoch(shard_dir, num_workers):
+    loader = _loader(shard_dir, num_workers)
+    batches, states = [], []
+    for imgs, _ in loader:
+        batches.append(imgs.tolist())
+        states.append(deepcopy(loader.state_dict()))
+    assert sorted(sum(batches, [])) == list(range(N_IMAGES))
+    assert loader.state_dict()['epoch'] == 1
+
+    # every position, including those after the first worker ran out of images
+    for k, state in enumerate(states[:-1]):
+        resumed = _loader(shard_dir, num_workers)
+        resumed.load_state_dict(state)
+        rest = [i for imgs, _ in resumed for i in imgs.tolist()]
+        assert Counter(rest) == Counter(sum(batches[k + 1:], [])), 'resumed after batch {}'.format(k)
+        assert resumed.state_dict()['epoch'] == 1
+
+
+def test_resume_needs_the_same_workers(shard_dir):
+    loader = _loader(shard_dir, 2)
+    next(iter(loader))
+    with pytest.raises(ValueError):
+        _loader(shard_dir, 3).load_state_dict(loader.state_dict())
@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import gc
 import random
 from torchvision.utils import make_grid
 import wandb
@@ -24,68 +23,90 @@ class FastGANTrainer(BaseGANTrainer):
         self.percept = lpips.PerceptualLoss(model='net-lin', net='vgg', use_gpu=True)
 
     def gen_loss(self, gen_imgs):
-        disc_out = self.model.discriminator(gen_imgs, label="fake").requires_grad_(True)
+        disc_out = self._forward_D(gen_imgs, label="fake").requires_grad_(True)
         g_loss = -disc_out.mean()
 
-        return g_loss, disc_out.detach().cpu()
+        return g_loss, disc_out.detach()
 
     def d_fake_loss(self, gen_imgs):
-        d_out_fake = self.model.discriminator([fi.detach() for fi in gen_imgs], label="fake").requires_grad_(True)
+        d_out_fake = self._forward_D([fi.detach() for fi in gen_imgs], label="fake").requires_grad_(True)
         d_fake_loss = F.relu(torch.rand_like(d_out_fake) * 0.2 + 0.8 + d_out_fake).mean()
 
-        return d_fake_loss, d_out_fake.detach().cpu()
+        return d_fake_loss, d_out_fake.detach()
 
-    def d_real_loss(self, real_imgs):
+    def d_real_loss(self, real_imgs, pyramid=None):
+        """
+        :param pyramid: Optional [imgs_small, parts] of the real images precomputed by the data loader (see
+            FastGANPyramidCollate), used instead of resizing real_imgs here.
+        """
         part = random.randint(0, 3)
-        d_out_real, [rec_all, rec_small, rec_part] = \
-            self.model.discriminator(real_imgs, label="real", part=part)
+        if pyramid is None:
+            d_input = real_imgs
+        else:
+            imgs_small, parts = pyramid
+            # the discriminator is wrapped by DataParallel on multiple GPUs
+            im_size = getattr(self.model.discriminator, 'module', self.model.discriminator).im_size
+            d_input = [self._resized(real_imgs, im_size), self._resized(imgs_small, 128)]
+        d_out_real, [rec_all, rec_small, rec_part] = self._forward_D(d_input, label="real", part=part)
+        if pyramid is None:
+            target_all = F.interpolate(real_imgs, rec_all.shape[2])
+            target_small = F.interpolate(real_imgs, rec_small.shape[2])
+            target_part = F.interpolate(crop_image_by_part(real_imgs, part), rec_part.shape[2])
+        else:
+            target_all = self._resized(imgs_small, rec_all.shape[2])
+            target_small = self._resized(imgs_small, rec_small.shape[2])
+            target_part = self._resized(parts[:, part], rec_part.shape[2])
         d_real_loss = F.relu(torch.rand_like(d_out_real) * 0.2 + 0.8 - d_out_real).mean() + \
-                      self.percept(rec_all, F.interpolate(real_imgs, rec_all.shape[2])).sum() + \
-                      self.percept(rec_small, F.interpolate(real_imgs, rec_small.shape[2])).sum() + \
-                      self.percept(rec_part,
-                                   F.interpolate(crop_image_by_part(real_imgs, part), rec_part.shape[2])).sum()
+                      self.percept(rec_all, target_all).sum() + \
+                      self.percept(rec_small, target_small).sum() + \
+                      self.percept(rec_part, target_part).sum()
+
+        return d_real_loss, d_out_real.detach(), rec_all.detach(), rec_small.detach(), rec_part.detach()
 
-        return d_real_loss, d_out_real.detach().cpu(), rec_all.detach(), rec_small.detach(), rec_part.detach()
+    @staticmethod
+    def _resized(imgs, size):
+        # precomputed levels already have the size the discriminator needs, so this is normally a no-op
+        return imgs if imgs.shape[2] == size else F.interpolate(imgs, size)
 
-    def _train_D(self, real_imgs, gen_imgs):
+    def _train_D(self, real_imgs, gen_imgs, pyramid=None):
         """Function for training D, returning current loss and D's probability predictions on real samples"""
         self.optimizer_D.zero_grad()
 
         # Measure discriminator's ability to classify real from generated samples
-        d_real_loss, d_out_real, rec_all, rec_small, rec_part = self.d_real_loss(real_imgs)
+        d_real_loss, d_out_real, rec_all, rec_small, rec_part = self.d_real_loss(real_imgs, pyramid)
         d_loss = d_real_loss.detach()
-        d_real_loss.backward()
+        self.scaler_D.scale(d_real_loss).backward()
 
         d_fake_loss, d_out_fake = self.d_fake_loss(gen_imgs=gen_imgs)
         d_loss += d_fake_loss.detach()
-        d_fake_loss.backward()
+        self.scaler_D.scale(d_fake_loss).backward()
 
-        self.optimizer_D.step()
+        self.scaler_D.step(self.optimizer_D)
+        self.scaler_D.update()
 
         ###LOG
         d_x = (0.5 * torch.mean(nn.Sigmoid()(d_out_real)) +
-               0.5 * torch.mean(1 - nn.Sigmoid()(d_out_fake))).detach().cpu().numpy()
-        self.train_metrics.update('d_out_real', d_out_real.numpy().mean())
+               0.5 * torch.mean(1 - nn.Sigmoid()(d_out_fake)))
+        self.train_metrics.update('d_out_real', d_out_real.mean())
         self.train_metrics.update('D(x)', d_x)
         del d_x
-        gc.collect()
 
-        return d_loss.item(), d_out_real.detach(), rec_all, rec_small, rec_part
+        return d_loss.detach(), d_out_real, rec_all, rec_small, rec_part
 
     def _train_G(self, gen_imgs):
         self.optimizer_G.zero_grad()
 
         g_loss, d_out_g = self.gen_loss(gen_imgs)
-        g_loss.backward()
+        self.scaler_G.scale(g_loss).backward()
 
-        self.optimizer_G.step()
-        d_gz = torch.mean(nn.Sigmoid()(d_out_g)).detach().cpu().numpy()
+        self.scaler_G.step(self.optimizer_G)
+        self.scaler_G.update()
+        d_gz = torch.mean(nn.Sigmoid()(d_out_g))
         self.train_metrics.update('D(G(z))', d_gz)
-        self.train_metrics.update('d_out_fake', d_out_g.numpy().mean())
+        self.train_metrics.update('d_out_fake', d_out_g.mean())
         del d_gz, d_out_g
-        gc.collect()
 
-        return g_loss.item()
+        return g_loss.detach()
 
     def _train_epoch(self, epoch):
         """
@@ -98,13 +119,18 @@ class FastGANTrainer(BaseGANTrainer):
         self.model.discriminator.train()
         self.train_metrics.reset()
 
-        for batch_idx, (real_img, _) in enumerate(self.data_loader):
-            real_img = real_img.to(self.device)
+        for batch_idx, (real_img, pyramid) in enumerate(self.data_loader):
+            real_img = self._prepare_real(real_img)
+            if isinstance(pyramid, (list, tuple)) and self.augment is None:
+                pyramid = [self._prepare_real(level) for level in pyramid]
+            else:
+                # augmentation changes the real images, so they are resized after it in d_real_loss
+                pyramid = None
 
             self.current_batch_size = real_img.shape[0]
             # Fake images
             z = self._sample_noise(self.current_batch_size)
-            gen_imgs = self.model.generator(z)
+            gen_imgs = self._forward_G(z)
 
             # Augment generated and real images
             if self.augment is not None:
@@ -113,7 +139,8 @@ class FastGANTrainer(BaseGANTrainer):
 
             # -----TRAIN DISCRIMINATOR-----
             d_loss, reals_out_D, rec_img_all, rec_img_small, rec_img_part = self._train_D(real_imgs=real_img,
-                                                                                          gen_imgs=gen_imgs)
+                                                                                          gen_imgs=gen_imgs,
+                                                                                          pyramid=pyramid)
 
             self.iters += 1
             # Update p value based on prediction of discriminator on real images
@@ -124,8 +151,6 @@ class FastGANTrainer(BaseGANTrainer):
                     self.train_metrics.update('p', self.augment.p)
 
                     del reals_out_D
-                    gc.collect()
-
                     self.augment.reset_lambda()
 
             # -----TRAIN GENERATOR-----
@@ -140,6 +165,7 @@ class FastGANTrainer(BaseGANTrainer):
             if self.iters % 10 == 0:
                 self.train_metrics.update('g_loss', -g_loss)
                 self.train_metrics.update('d_loss', d_loss)
+                self.train_metrics.sync()
                 self.logger.debug('Train Epoch: {} {} G_Loss: {:.6f} D_Loss: {:.6f}'.format(
                     epoch,
                     self._progress(batch_idx),
@@ -167,7 +193,7 @@ class FastGANTrainer(BaseGANTrainer):
                 self._save_checkpoint(epoch)
 
             del d_loss, g_loss
-            gc.collect()
+            self.memory.step()
 
             if batch_idx == self.len_epoch:
                 break
@@ -185,12 +211,14 @@ class FastGANTrainer(BaseGANTrainer):
         Full training logic
         """
         self.init_lpips()
+        self.memory.freeze()
         for epoch in range(self.start_epoch, self.epochs + 1):
             result = self._train_epoch(epoch)
 
             # save logged informations into log dict
             log = {'epoch': epoch}
             log.update(result)
+            log.update(self.memory.stats())
 
             # print logged informations to the screen
             for key, value in log.items():
@@ -208,11 +236,10 @@ class FastGANTrainer(BaseGANTrainer):
 
         :param epoch: Integer, current training epoch.
         """
+        self.model.generator.eval()
+        backup_para = copy_G_params(self.model.generator)
+        load_params(self.model.generator, self.avg_param_G)
         if self.writer is not None:
-            self.model.generator.eval()
-            backup_para = copy_G_params(self.model.generator)
-            load_params(self.model.generator, self.avg_param_G)
-
             with torch.no_grad():
                 fake_imgs = self.model.generator(self.fixed_noise)
                 self.writer.set_step(epoch, 'valid')
@@ -225,11 +252,15 @@ class FastGANTrainer(BaseGANTrainer):
                     del images
 
                 del fake_imgs
-                gc.collect()
-            load_params(self.model.generator, backup_para)
+        # score the EMA generator, with or without a writer as in BaseGANTrainer._valid_epoch
+        self._monitor_fid(self.iters)
+        load_params(self.model.generator, backup_para)
+        # called mid-epoch, training continues after it
+        self.model.generator.train()
 
+        if self.writer is not None:
             # Add 8 real images to tensorboard
-            real_imgs, _ = next(iter(self.data_loader))
+            real_imgs = self._sample_real_batch()
             self.writer.set_step(epoch, 'valid')
             if self.writer.name == "tensorboard":
                 self.writer.add_image('real', make_grid(real_imgs[:8], nrow=4, normalize=True))
@@ -239,7 +270,6 @@ class FastGANTrainer(BaseGANTrainer):
                 del images
 
             del real_imgs
-            gc.collect()
 
     def _save_checkpoint(self, epoch):
         """
@@ -261,6 +291,9 @@ class FastGANTrainer(BaseGANTrainer):
             'lr_scheduler_G': self.lr_scheduler_G.state_dict(),
             'lr_scheduler_D': self.lr_scheduler_D.state_dict(),
             'augment': self.augment.state_dict() if self.augment else None,
+            'scaler_G': self.scaler_G.state_dict(),
+            'scaler_D': self.scaler_D.state_dict(),
+            'data_loader': self.data_position.state_dict() if self.data_position is not None else None,
             'config': self.config
         }
         filename = str(self.checkpoint_dir / 'checkpoint-epoch{}.pth'.format(epoch))
@@ -322,4 +355,13 @@ class FastGANTrainer(BaseGANTrainer):
         if self.augment:
             self.augment.load_state_dict(checkpoint['augment'])
 
+        # load the loss scales of fp16 training, absent (or empty) in checkpoints of other runs
+        if checkpoint.get('scaler_G'):
+            self.scaler_G.load_state_dict(checkpoint['scaler_G'])
+            self.scaler_D.load_state_dict(checkpoint['scaler_D'])
+
+        # load the position in the data, so that the run continues with the batches it would have taken next
+        if checkpoint.get('data_loader') is not None and self.data_position is not None:
+            self.data_position.load_state_dict(checkpoint['data_loader'])
+
         self.logger.info("Checkpoint loaded. Resume training from epoch {}".format(self.start_epoch))
\ No newline at end of file
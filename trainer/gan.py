@@ -1,5 +1,3 @@
-import gc
-
 from base import BaseGANTrainer
 
 
@@ -25,13 +23,15 @@ class GANTrainer(BaseGANTrainer):
         self.train_metrics.reset()
 
         for batch_idx, (real_imgs, _) in enumerate(self.data_loader):
-            real_imgs = real_imgs.to(self.device)
+            real_imgs = self._prepare_real(real_imgs)
             self.current_batch_size = real_imgs.shape[0]
+            gen_imgs = self._shared_fakes()
             # -----TRAIN GENERATOR-----
-            d_loss = self._train_G()
+            d_loss = self._train_G(gen_imgs)
 
             # -----TRAIN DISCRIMINATOR-----
-            g_loss, reals_out_D = self._train_D(real_imgs=real_imgs)
+            g_loss, reals_out_D = self._train_D(real_imgs=real_imgs, gen_imgs=gen_imgs)
+            del gen_imgs
 
             self.iters += 1
             # Update p value based on prediction of discriminator on real images
@@ -42,8 +42,6 @@ class GANTrainer(BaseGANTrainer):
                     self.train_metrics.update('p', self.augment.p)
 
                     del reals_out_D
-                    gc.collect()
-
                     self.augment.reset_lambda()
 
             # Log loss
@@ -53,13 +51,14 @@ class GANTrainer(BaseGANTrainer):
             self.train_metrics.update('d_loss', d_loss)
 
             if batch_idx % self.log_step == 0:
+                self.train_metrics.sync()
                 self.logger.debug('Train Epoch: {} {} G_Loss: {:.6f} D_Loss: {:.6f}'.format(
                     epoch,
                     self._progress(batch_idx),
                     g_loss, d_loss))
 
             del d_loss, g_loss
-            gc.collect()
+            self.memory.step()
 
             if batch_idx == self.len_epoch:
                 break
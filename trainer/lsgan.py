@@ -1,5 +1,4 @@
 import torch
-import gc
 
 from base import BaseGANTrainer
 
@@ -14,29 +13,29 @@ class LSGANTrainer(BaseGANTrainer):
         self.gen_c = config["trainer"]["c"] if config["trainer"]["c"] != "None" else 1
 
     def gen_loss(self, gen_imgs):
-        disc_out = self.model.discriminator(gen_imgs).requires_grad_(True)
+        disc_out = self._forward_D(gen_imgs).requires_grad_(True)
         g_loss = self.criterion(disc_out, torch.full([self.current_batch_size, 1], self.gen_c, dtype=torch.float32).to(
             self.device))
 
-        return g_loss, disc_out.detach().cpu()
+        return g_loss, disc_out.detach()
 
     def d_fake_loss(self, gen_imgs):
-        d_out_fake = self.model.discriminator(gen_imgs).requires_grad_(True)
+        d_out_fake = self._forward_D(gen_imgs).requires_grad_(True)
 
         d_fake_loss = self.criterion(d_out_fake,
                                      torch.full([self.current_batch_size, 1], self.dis_a, dtype=torch.float32).to(
                                          self.device))
 
-        return d_fake_loss, d_out_fake.detach().cpu()
+        return d_fake_loss, d_out_fake.detach()
 
     def d_real_loss(self, real_imgs):
-        d_out_real = self.model.discriminator(real_imgs).requires_grad_(True)
+        d_out_real = self._forward_D(real_imgs).requires_grad_(True)
 
         d_real_loss = self.criterion(d_out_real,
                                      torch.full([self.current_batch_size, 1], self.dis_b, dtype=torch.float32).to(
                                          self.device))
 
-        return d_real_loss, d_out_real.detach().cpu()
+        return d_real_loss, d_out_real.detach()
 
     def _train_epoch(self, epoch):
         """
@@ -50,13 +49,15 @@ class LSGANTrainer(BaseGANTrainer):
         self.train_metrics.reset()
 
         for batch_idx, (real_imgs, _) in enumerate(self.data_loader):
-            real_imgs = real_imgs.to(self.device)
+            real_imgs = self._prepare_real(real_imgs)
             self.current_batch_size = real_imgs.shape[0]
+            gen_imgs = self._shared_fakes()
             # -----TRAIN GENERATOR-----
-            d_loss = self._train_G()
+            d_loss = self._train_G(gen_imgs)
 
             # -----TRAIN DISCRIMINATOR-----
-            g_loss, reals_out_D = self._train_D(real_imgs=real_imgs)
+            g_loss, reals_out_D = self._train_D(real_imgs=real_imgs, gen_imgs=gen_imgs)
+            del gen_imgs
 
             self.iters += 1
             # Update p value based on prediction of discriminator on real images
@@ -67,8 +68,6 @@ class LSGANTrainer(BaseGANTrainer):
                     self.train_metrics.update('p', self.augment.p)
 
                     del reals_out_D
-                    gc.collect()
-
                     self.augment.reset_lambda()
 
             # Log loss
@@ -78,13 +77,14 @@ class LSGANTrainer(BaseGANTrainer):
             self.train_metrics.update('d_loss', d_loss)
 
             if batch_idx % self.log_step == 0:
+                self.train_metrics.sync()
                 self.logger.debug('Train Epoch: {} {} G_Loss: {:.6f} D_Loss: {:.6f}'.format(
                     epoch,
                     self._progress(batch_idx),
                     g_loss, d_loss))
 
             del d_loss, g_loss
-            gc.collect()
+            self.memory.step()
 
             if batch_idx == self.len_epoch:
                 break
@@ -1,5 +1,4 @@
 import torch
-import gc
 
 from base import BaseGANTrainer
 
@@ -16,26 +15,26 @@ class WGANTrainer(BaseGANTrainer):
         self.clip_value = self.config["trainer"]["clip"]
 
     def gen_loss(self, gen_imgs):
-        disc_out = self.model.discriminator(gen_imgs).requires_grad_(True)
+        disc_out = self._forward_D(gen_imgs).requires_grad_(True)
         # self.train_metrics.update('D(G(z))', torch.mean(nn.Sigmoid()(disc_out)))
 
         g_loss = -torch.mean(disc_out)
 
-        return g_loss, disc_out.detach().cpu()
+        return g_loss, disc_out.detach()
 
     def d_fake_loss(self, gen_imgs):
-        d_out_fake = self.model.discriminator(gen_imgs.detach()).requires_grad_(True)
+        d_out_fake = self._forward_D(gen_imgs.detach()).requires_grad_(True)
 
         d_fake_loss = torch.mean(d_out_fake)
 
-        return d_fake_loss, d_out_fake.detach().cpu()
+        return d_fake_loss, d_out_fake.detach()
 
     def d_real_loss(self, real_imgs):
-        d_out_real = self.model.discriminator(real_imgs).requires_grad_(True)
+        d_out_real = self._forward_D(real_imgs).requires_grad_(True)
 
         d_real_loss = -torch.mean(d_out_real)
 
-        return d_real_loss, d_out_real.detach().cpu()
+        return d_real_loss, d_out_real.detach()
 
     def _train_epoch(self, epoch):
         """
@@ -49,15 +48,18 @@ class WGANTrainer(BaseGANTrainer):
         self.train_metrics.reset()
 
         for batch_idx, (real_imgs, _) in enumerate(self.data_loader):
-            real_imgs = real_imgs.to(self.device)
+            real_imgs = self._prepare_real(real_imgs)
             self.current_batch_size = real_imgs.shape[0]
+            # D is trained first, the shared fakes keep their graph through the D step for the G step
+            gen_imgs = self._shared_fakes()
             # -----TRAIN DISCRIMINATOR-----
-            d_loss, reals_out_D = self._train_D(real_imgs=real_imgs)
+            d_loss, reals_out_D = self._train_D(real_imgs=real_imgs, gen_imgs=gen_imgs)
 
             for param in self.model.discriminator.parameters():
                 param.data.clamp_(-self.clip_value, self.clip_value)
             # -----TRAIN GENERATOR-----
-            g_loss = self._train_G()
+            g_loss = self._train_G(gen_imgs)
+            del gen_imgs
 
             self.iters += 1
             # Update p value based on prediction of discriminator on real images
@@ -68,8 +70,6 @@ class WGANTrainer(BaseGANTrainer):
                     self.train_metrics.update('p', self.augment.p)
 
                     del reals_out_D
-                    gc.collect()
-
                     self.augment.reset_lambda()
 
             # Log loss
@@ -78,13 +78,14 @@ class WGANTrainer(BaseGANTrainer):
             self.train_metrics.update('d_loss', d_loss)
 
             if batch_idx % self.log_step == 0:
+                self.train_metrics.sync()
                 self.logger.debug('Train Epoch: {} {} G_Loss: {:.6f} D_Loss: {:.6f}'.format(
                     epoch,
                     self._progress(batch_idx),
                     g_loss, d_loss))
 
             del d_loss, g_loss
-            gc.collect()
+            self.memory.step()
 
             if batch_idx == self.len_epoch:
                 break
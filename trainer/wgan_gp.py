@@ -1,9 +1,6 @@
 import torch
-from torch.autograd import Variable
 import torch.autograd as autograd
 import torch.nn as nn
-import numpy as np
-import gc
 
 from base import BaseGANTrainer
 
@@ -20,60 +17,66 @@ class WGANGPTrainer(BaseGANTrainer):
         self.lambda_gp = lambda_gp
 
     def gen_loss(self, gen_imgs):
-        disc_out = self.model.discriminator(gen_imgs).requires_grad_(True)
+        disc_out = self._forward_D(gen_imgs).requires_grad_(True)
         # self.train_metrics.update('D(G(z))', torch.mean(nn.Sigmoid()(disc_out)))
 
         g_loss = -torch.mean(disc_out)
 
-        return g_loss, disc_out.detach().cpu()
+        return g_loss, disc_out.detach()
 
     def d_fake_loss(self, gen_imgs):
-        d_out_fake = self.model.discriminator(gen_imgs.detach()).requires_grad_(True)
+        d_out_fake = self._forward_D(gen_imgs.detach()).requires_grad_(True)
 
         d_fake_loss = torch.mean(d_out_fake)
 
-        return d_fake_loss, d_out_fake.detach().cpu()
+        return d_fake_loss, d_out_fake.detach()
 
     def d_real_loss(self, real_imgs):
-        d_out_real = self.model.discriminator(real_imgs).requires_grad_(True)
+        d_out_real = self._forward_D(real_imgs).requires_grad_(True)
 
         d_real_loss = -torch.mean(d_out_real)
 
-        return d_real_loss, d_out_real.detach().cpu()
+        return d_real_loss, d_out_real.detach()
 
     def compute_gradient_penalty(self, D, real_samples, fake_samples):
-        """Calculates the gradient penalty loss for WGAN GP"""
-        # Random weight term for interpolation between real and fake samples
-        cuda = True if torch.cuda.is_available() else False
-
-        Tensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
+        """
+        Calculates the gradient penalty loss for WGAN GP
 
-        alpha = Tensor(np.random.random((real_samples.size(0), 1, 1, 1)))
+        :param D: Discriminator forward. With fp16, D's output is scaled by scaler_D before the gradient is taken (so
+            that small gradients do not flush to zero) and the gradient is unscaled before its norm.
+        """
+        # drawn on the device, copying host random numbers in would wait for the queued work
+        alpha = torch.rand(real_samples.size(0), 1, 1, 1, device=real_samples.device)
         # Get random interpolation between real and fake samples
         interpolates = (alpha * real_samples + ((1 - alpha) * fake_samples)).requires_grad_(True)
         d_interpolates = D(interpolates)
-        fake = Variable(Tensor(real_samples.shape[0], 1).fill_(1.0), requires_grad=False)
         # Get gradient w.r.t. interpolates
         gradients = autograd.grad(
-            outputs=d_interpolates,
+            outputs=self.scaler_D.scale(d_interpolates),
             inputs=interpolates,
-            grad_outputs=fake,
+            grad_outputs=torch.ones_like(d_interpolates),
             create_graph=True,
             retain_graph=True,
             only_inputs=True,
         )[0]
+        # get_scale() is 1 when the scaler is disabled
+        gradients = gradients / self.scaler_D.get_scale()
         gradients = gradients.view(gradients.size(0), -1)
         gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean()
         return gradient_penalty
 
-    def _train_D(self, real_imgs):
-        """Function for training D, returning current loss and D's probability predictions on real samples"""
-        self.optimizer_D.zero_grad()
-        # Sample noise as generator input
-        z = self._sample_noise(self.current_batch_size)
-        # Generate a batch of images
+    def _train_D(self, real_imgs, gen_imgs=None):
+        """
+        Function for training D, returning current loss and D's probability predictions on real samples
 
-        gen_imgs = self.model.generator(z)
+        :param gen_imgs: Generated images shared with the G step (see reuse_fakes), generated here if None.
+        """
+        self.optimizer_D.zero_grad()
+        # Generate a batch of images, no gradient flows back to the generator in this step
+        if gen_imgs is None:
+            with torch.no_grad():
+                gen_imgs = self._generate()
+        gen_imgs = gen_imgs.detach()
 
         # Augment real and generated images
         if self.augment is not None:
@@ -85,20 +88,21 @@ class WGANGPTrainer(BaseGANTrainer):
 
         d_fake_loss, d_out_fake = self.d_fake_loss(gen_imgs=gen_imgs)
 
-        gradient_penalty = self.compute_gradient_penalty(self.model.discriminator, real_imgs, gen_imgs)
+        gradient_penalty = self.compute_gradient_penalty(self._forward_D, real_imgs, gen_imgs)
 
         d_loss = d_real_loss + d_fake_loss + self.lambda_gp * gradient_penalty
-        d_loss.backward()
+        self.scaler_D.scale(d_loss).backward()
 
-        self.optimizer_D.step()
+        self.scaler_D.step(self.optimizer_D)
+        self.scaler_D.update()
 
         ###LOG
         dx = (0.5 * torch.mean(nn.Sigmoid()(d_out_real)) +
-              0.5 * torch.mean(1 - nn.Sigmoid()(d_out_fake))).detach().cpu()
+              0.5 * torch.mean(1 - nn.Sigmoid()(d_out_fake)))
         self.train_metrics.update('D(x)', dx)
-        self.train_metrics.update('d_out_real', d_out_real.numpy().mean())
+        self.train_metrics.update('d_out_real', d_out_real.mean())
 
-        return d_loss.item(), d_out_real.detach()
+        return d_loss.detach(), d_out_real
 
     def _train_epoch(self, epoch):
         """
@@ -112,13 +116,15 @@ class WGANGPTrainer(BaseGANTrainer):
         self.train_metrics.reset()
 
         for batch_idx, (real_imgs, _) in enumerate(self.data_loader):
-            real_imgs = real_imgs.to(self.device)
+            real_imgs = self._prepare_real(real_imgs)
             self.current_batch_size = real_imgs.shape[0]
+            gen_imgs = self._shared_fakes()
             # -----TRAIN GENERATOR-----
-            g_loss = self._train_G()
+            g_loss = self._train_G(gen_imgs)
 
             # -----TRAIN DISCRIMINATOR-----
-            d_loss, reals_out_D = self._train_D(real_imgs=real_imgs)
+            d_loss, reals_out_D = self._train_D(real_imgs=real_imgs, gen_imgs=gen_imgs)
+            del gen_imgs
 
             self.iters += 1
             # Update p value based on prediction of discriminator on real images
@@ -129,8 +135,6 @@ class WGANGPTrainer(BaseGANTrainer):
                     self.train_metrics.update('p', self.augment.p)
 
                     del reals_out_D
-                    gc.collect()
-
                     self.augment.reset_lambda()
 
             # Log loss
@@ -139,12 +143,13 @@ class WGANGPTrainer(BaseGANTrainer):
             self.train_metrics.update('d_loss', d_loss)
 
             if batch_idx % self.log_step == 0:
+                self.train_metrics.sync()
                 self.logger.debug('Train Epoch: {} {} G_Loss: {:.6f} D_Loss: {:.6f}'.format(
                     epoch,
                     self._progress(batch_idx),
                     g_loss, d_loss))
             del d_loss, g_loss
-            gc.collect()
+            self.memory.step()
 
             if batch_idx == self.len_epoch:
                 break
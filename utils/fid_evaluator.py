@@ -0,0 +1,303 @@
+"""Scores many checkpoints against one reference set.
+
+Inception and the reference statistics are built once and stay resident.
+Loading the next checkpoint, generating images and extracting features run
+concurrently, so neither disk nor the generator leaves inception idle.
+"""
+import hashlib
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from utils.fid_score import (ActivationStatistics, _collect_activations,
+                             _pooled_activations,
+                             calculate_activation_statistics,
+                             calculate_fid_bootstrap, calculate_fid_infinity,
+                             calculate_frechet_distance,
+                             compute_statistics_of_path,
+                             generated_to_inception_input, list_image_files)
+from utils.inception_score import InceptionV3
+from utils.latent_bank import LatentBank
+
+try:
+    from tqdm import tqdm
+except ImportError:
+    # If tqdm is not available, provide a mock version of it
+    def tqdm(x, **kwargs):
+        return x
+
+
+def checkpoint_hash(path, chunk_size=1 << 20):
+    """sha1 of a checkpoint file's contents"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _logits_path(features_path):
+    return features_path[:-len('.npy')] + '-logits.npy'
+
+
+def save_features(path, features, logits=None):
+    """Stores features (and logits) as float16 .npy files that
+    `load_features` memory-maps"""
+    for file, array in ((path, features), (_logits_path(path), logits)):
+        if array is None:
+            continue
+        tmp_path = file + '.tmp.%d.npy' % os.getpid()
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16,
+                                        shape=array.shape)
+        out[:] = array
+        out.flush()
+        del out
+        os.replace(tmp_path, file)
+
+
+def load_features(path):
+    """Memory-mapped features and logits (None if they were not stored),
+    converted to float32"""
+    features = np.load(path, mmap_mode='r').astype(np.float32)
+    logits = None
+    if os.path.exists(_logits_path(path)):
+        logits = np.load(_logits_path(path), mmap_mode='r').astype(np.float32)
+    return features, logits
+
+
+class FIDEvaluator:
+    def __init__(self, ref_path, batch_size, device, dims=2048, num_workers=1,
+                 portion=1.0, prefetch=2, sqrtm_method='scipy', seed=0,
+                 feature_cache=False):
+        """
+        Params:
+        -- ref_path    : .npz statistics file or directory of reference images
+        -- batch_size  : Batch size for generation and inception
+        -- device      : Device to run calculations
+        -- dims        : Dimensionality of features returned by Inception
+        -- num_workers : Number of dataloader workers for image directories
+        -- portion     : Portion of the reference directory to use
+        -- prefetch    : Number of generated batches queued ahead of inception
+        -- sqrtm_method: Matrix square root used for the FID, see
+                         `calculate_frechet_distance`
+        -- seed        : Seed of the `LatentBank` the generator noise is
+                         taken from
+        -- feature_cache: If true, `evaluate` stores the features of the
+                         generated images next to each checkpoint and reuses
+                         them instead of generating again, see
+                         `feature_cache_path`
+        """
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.dims = dims
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.sqrtm_method = sqrtm_method
+        self.seed = seed
+        self.feature_cache = feature_cache
+
+        self.model = self._build_inception().to(self.device)
+        self.model.eval()
+        self.mu_ref, self.sigma_ref = self._reference_statistics(ref_path,
+                                                                 portion)
+
+    def _build_inception(self):
+        block_idx = InceptionV3.BLOCK_INDEX_BY_DIM[self.dims]
+        return InceptionV3([block_idx])
+
+    def _reference_statistics(self, ref_path, portion):
+        return compute_statistics_of_path(
+            ref_path, self.model, self.batch_size, self.dims, self.device,
+            self.num_workers, portion=portion)
+
+    def score_path(self, path):
+        """FID of the images in directory `path` against the reference"""
+        files = list_image_files(path)
+        mu, sigma = calculate_activation_statistics(
+            files, self.model, self.batch_size, self.dims, self.device,
+            self.num_workers)
+        return calculate_frechet_distance(mu, sigma, self.mu_ref,
+                                          self.sigma_ref,
+                                          method=self.sqrtm_method,
+                                          device=self.device)
+
+    def score_features(self, features, logits=None):
+        """FID of a (N, dims) matrix of generated image features"""
+        return calculate_frechet_distance(np.mean(features, axis=0,
+                                                  dtype=np.float64),
+                                          np.cov(features, rowvar=False),
+                                          self.mu_ref, self.sigma_ref,
+                                          method=self.sqrtm_method,
+                                          device=self.device)
+
+    def generator_features(self, generator, latent_dim, n_sample):
+        """Features of the first `n_sample` images of the latent bank and, for
+        evaluators that extract them, logits (else None)"""
+        features = _collect_activations(
+            (_pooled_activations(self.model, batch) for batch in
+             self._generated_batches(generator, latent_dim, n_sample)),
+            n_sample, self.dims)
+        return features, None
+
+    def accumulate_generator(self, generator, latent_dim, start, stop):
+        """Activation statistics of latent bank samples start, ..., stop - 1.
+
+        Shards of one sample range can be accumulated by different processes
+        and combined exactly with `ActivationStatistics.merge`.
+        """
+        stats = ActivationStatistics(self.dims, self.device)
+        for batch in self._generated_batches(generator, latent_dim, stop,
+                                             start):
+            stats.update(_pooled_activations(self.model, batch))
+        return stats
+
+    def score_statistics(self, stats):
+        """FID of an `ActivationStatistics` accumulator"""
+        mu, sigma = stats.compute()
+        return calculate_frechet_distance(mu, sigma, self.mu_ref,
+                                          self.sigma_ref,
+                                          method=self.sqrtm_method,
+                                          device=self.device)
+
+    def score_generator(self, generator, latent_dim, n_sample):
+        """FID of the first `n_sample` images of the latent bank"""
+        return self.score_statistics(
+            self.accumulate_generator(generator, latent_dim, 0, n_sample))
+
+    def score_generator_subset(self, generator, latent_dim, n_sample,
+                               n_bootstrap=10, fid_infinity=False):
+        """Cheap FID estimate from a few thousand samples for monitoring.
+
+        Returns a dict with the point estimate `fid`, the bootstrap interval
+        `fid_lo`/`fid_hi` and, if requested, the extrapolated `fid_inf`.
+        """
+        act, _ = FIDEvaluator.generator_features(self, generator, latent_dim,
+                                                 n_sample)
+        fid, (lo, hi) = calculate_fid_bootstrap(act, self.mu_ref,
+                                                self.sigma_ref, n_bootstrap,
+                                                method=self.sqrtm_method,
+                                                device=self.device)
+        result = {'fid': fid, 'fid_lo': lo, 'fid_hi': hi}
+        if fid_infinity:
+            result['fid_inf'] = calculate_fid_infinity(
+                act, self.mu_ref, self.sigma_ref, method=self.sqrtm_method,
+                device=self.device)
+        return result
+
+    def evaluate(self, model, ckpts, n_sample):
+        """Scores every checkpoint in `ckpts` with the generator of `model`.
+
+        The next checkpoint is read from disk in a background thread while the
+        current one is being scored. With `feature_cache` set, checkpoints
+        whose generated features are already cached are scored from those
+        without being loaded. Yields `(ckpt, result)` pairs in order.
+        """
+        cache_paths = {}
+        if self.feature_cache:
+            cache_paths = {ckpt: self.feature_cache_path(ckpt, n_sample)
+                           for ckpt in ckpts}
+        to_load = [ckpt for ckpt in ckpts
+                   if ckpt not in cache_paths
+                   or not self._has_cached_features(cache_paths[ckpt])]
+
+        with ThreadPoolExecutor(max_workers=1) as loader:
+            loads = [loader.submit(torch.load, to_load[0], map_location='cpu')
+                     ] if to_load else []
+            for ckpt in ckpts:
+                if ckpt not in to_load:
+                    yield ckpt, self.score_features(
+                        *load_features(cache_paths[ckpt]))
+                    continue
+
+                checkpoint = loads.pop(0).result()
+                i = to_load.index(ckpt)
+                if i + 1 < len(to_load):
+                    loads.append(loader.submit(torch.load, to_load[i + 1],
+                                               map_location='cpu'))
+                model.load_state_dict(checkpoint['state_dict'])
+                del checkpoint
+                model.to(self.device)
+
+                if ckpt in cache_paths:
+                    features, logits = self.generator_features(
+                        model.generator, model.latent_dim, n_sample)
+                    save_features(cache_paths[ckpt], features, logits)
+                    del features, logits
+                    # score the stored float16 values so that re-scoring from
+                    # the cache reproduces this result exactly
+                    yield ckpt, self.score_features(
+                        *load_features(cache_paths[ckpt]))
+                else:
+                    yield ckpt, self.score_generator(model.generator,
+                                                     model.latent_dim,
+                                                     n_sample)
+
+    def feature_cache_path(self, ckpt, n_sample):
+        """Cache file of the generated features of a checkpoint, next to it.
+
+        The name is keyed by the checkpoint contents, seed, n_sample and
+        feature dims, so retraining or changing the sampling settings never
+        picks up stale features.
+        """
+        key = hashlib.sha1('{};seed={};n_sample={};dims={}'.format(
+            checkpoint_hash(ckpt), self.seed, n_sample,
+            self.dims).encode()).hexdigest()[:16]
+        return '{}.features-{}.npy'.format(os.path.splitext(ckpt)[0], key)
+
+    def _has_cached_features(self, path):
+        return os.path.exists(path)
+
+    def _generated_batches(self, generator, latent_dim, stop, start=0):
+        """Yields inception-ready generated batches for latent bank samples
+        start, ..., stop - 1, produced by a worker thread, on its own CUDA
+        stream when running on GPU"""
+        generator.eval()
+        bank = LatentBank(self.seed, latent_dim)
+        n_batches = -(-(stop - start) // self.batch_size)
+        batches = queue.Queue(maxsize=self.prefetch)
+        stopped = threading.Event()
+        use_cuda = self.device.type == 'cuda'
+
+        def produce():
+            try:
+                stream = torch.cuda.Stream(self.device) if use_cuda else None
+                for noise in bank.batches(start, stop, self.batch_size):
+                    if stopped.is_set():
+                        return
+                    with torch.no_grad(), torch.cuda.stream(stream):
+                        noise = noise.to(self.device, non_blocking=True)
+                        batch = generated_to_inception_input(generator(noise))
+                        event = None
+                        if use_cuda:
+                            event = torch.cuda.Event()
+                            event.record(stream)
+                    batches.put((batch, event))
+                batches.put(None)
+            except BaseException as e:
+                batches.put(e)
+
+        worker = threading.Thread(target=produce, daemon=True)
+        worker.start()
+        try:
+            for _ in tqdm(range(n_batches)):
+                item = batches.get()
+                if isinstance(item, BaseException):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    torch.cuda.current_stream(self.device).wait_event(event)
+                    batch.record_stream(torch.cuda.current_stream(self.device))
+                yield batch
+        finally:
+            stopped.set()
+            # unblock the producer if it is waiting on a full queue
+            while worker.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            worker.join()
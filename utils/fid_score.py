@@ -31,6 +31,7 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import hashlib
 import os
 import pathlib
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
@@ -40,6 +41,7 @@ import torch
 import torchvision.transforms as TF
 from PIL import Image
 from scipy import linalg
+from scipy.stats import norm
 from torch.nn.functional import adaptive_avg_pool2d
 
 try:
@@ -50,6 +52,7 @@ except ImportError:
         return x
 
 from utils.inception_score import InceptionV3
+from utils.file_index import load_file_index
 
 parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
 parser.add_argument('--batch-size', type=int, default=50,
@@ -63,13 +66,53 @@ parser.add_argument('--dims', type=int, default=2048,
                     choices=list(InceptionV3.BLOCK_INDEX_BY_DIM),
                     help=('Dimensionality of Inception features to use. '
                           'By default, uses pool3 features'))
-parser.add_argument('path', type=str, nargs=2,
+parser.add_argument('--sqrtm', type=str, default='scipy',
+                    choices=['scipy', 'eigh', 'newton_schulz'],
+                    help=('How the matrix square root of the FID is computed. '
+                          'eigh and newton_schulz run in torch on --device'))
+parser.add_argument('--check-sqrtm', action='store_true',
+                    help=('Compare the FID of the eigh and newton_schulz '
+                          'methods against scipy on random rank-deficient '
+                          'covariances of --dims features, instead of '
+                          'computing a FID'))
+parser.add_argument('path', type=str, nargs='*',
                     help=('Paths to the generated images or '
                           'to .npz statistic files'))
 
 IMAGE_EXTENSIONS = {'bmp', 'jpg', 'jpeg', 'pgm', 'png', 'ppm',
                     'tif', 'tiff', 'webp'}
 
+# Reference statistics of image directories are cached here, keyed by
+# `statistics_cache_key`
+STATS_CACHE_DIR = os.environ.get(
+    'FID_STATS_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'gan-ada', 'fid_stats'))
+
+
+class NpyShardDataset(torch.utils.data.Dataset):
+    """Images stored as (N, H, W, C) uint8 .npy shards, e.g. by
+    `utils.image_writer.ImageWriterPool`, indexed across all shards"""
+    def __init__(self, files, transforms=None):
+        self.files = files
+        self.transforms = transforms
+        lengths = [np.load(file, mmap_mode='r').shape[0] for file in files]
+        self.offsets = np.cumsum([0] + lengths)
+        self._shards = {}
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, i):
+        shard_idx = np.searchsorted(self.offsets, i, side='right') - 1
+        if shard_idx not in self._shards:
+            # opened lazily so that every dataloader worker maps its own
+            self._shards[shard_idx] = np.load(self.files[shard_idx],
+                                              mmap_mode='r')
+        img = np.array(self._shards[shard_idx][i - self.offsets[shard_idx]])
+        if self.transforms is not None:
+            img = self.transforms(img)
+        return img
+
 
 class ImagePathDataset(torch.utils.data.Dataset):
     def __init__(self, files, transforms=None):
@@ -87,6 +130,113 @@ class ImagePathDataset(torch.utils.data.Dataset):
         return img
 
 
+class ActivationStatistics:
+    """Running mean and covariance of inception activations.
+
+    Batches are folded in one at a time with the pairwise update of Chan et
+    al., so memory stays at O(dims^2) however many samples are scored. Sums
+    are kept in float64 on the device the accumulator was created on.
+    Accumulators filled by different workers can be combined with `merge`.
+    """
+    def __init__(self, dims=2048, device='cpu'):
+        self.dims = dims
+        self.n = 0
+        self.mean = torch.zeros(dims, dtype=torch.float64, device=device)
+        self.m2 = torch.zeros(dims, dims, dtype=torch.float64, device=device)
+
+    def update(self, act):
+        """Adds a (B, dims) batch of activations, tensor or numpy array"""
+        act = torch.as_tensor(act).to(self.mean.device, torch.float64)
+        n_b = act.shape[0]
+        if n_b == 0:
+            return self
+        mean_b = act.mean(dim=0)
+        centered = act - mean_b
+        self._combine(n_b, mean_b, centered.T @ centered)
+        return self
+
+    def merge(self, other):
+        """Folds the samples of another accumulator into this one"""
+        if other.n > 0:
+            self._combine(other.n, other.mean.to(self.mean.device),
+                          other.m2.to(self.mean.device))
+        return self
+
+    def _combine(self, n_b, mean_b, m2_b):
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * (n_b / n)
+        self.m2 += m2_b + torch.outer(delta, delta) * (self.n * n_b / n)
+        self.n = n
+
+    def compute(self):
+        """Returns mu and sigma as numpy arrays, matching `np.mean` and
+        `np.cov(rowvar=False)` over all added activations"""
+        assert self.n > 1, 'At least two samples are needed for a covariance'
+        mu = self.mean.cpu().numpy()
+        sigma = (self.m2 / (self.n - 1)).cpu().numpy()
+        return mu, sigma
+
+    def state_dict(self):
+        return {'n': self.n, 'mean': self.mean.cpu(), 'm2': self.m2.cpu()}
+
+    def load_state_dict(self, state_dict):
+        self.n = state_dict['n']
+        self.mean = state_dict['mean'].to(self.mean.device, torch.float64)
+        self.m2 = state_dict['m2'].to(self.m2.device, torch.float64)
+        self.dims = self.mean.shape[0]
+
+
+def _path_activation_batches(files, model, batch_size=50, device='cpu',
+                             num_workers=1):
+    """Yields (B, dims) activations for the images in `files`"""
+    model.eval()
+
+    for batch in path_image_batches(files, batch_size, device, num_workers):
+        yield _pooled_activations(model, batch)
+
+
+def image_dataset(files):
+    """Dataset of image files or, if `files` are .npy shards, of the images
+    stored in them, as (3, H, W) tensors in range (0, 1)"""
+    if files and all(str(file).endswith('.npy') for file in files):
+        return NpyShardDataset(files, transforms=TF.ToTensor())
+    return ImagePathDataset(files, transforms=TF.ToTensor())
+
+
+def path_image_batches(files, batch_size=50, device='cpu', num_workers=1):
+    """Yields the images in `files` as (B, 3, H, W) batches in range (0, 1)"""
+    dataset = image_dataset(files)
+    if batch_size > len(dataset):
+        print(('Warning: batch size is bigger than the data size. '
+               'Setting batch size to data size'))
+        batch_size = len(dataset)
+
+    dataloader = torch.utils.data.DataLoader(dataset,
+                                             batch_size=batch_size,
+                                             shuffle=False,
+                                             drop_last=False,
+                                             num_workers=num_workers)
+
+    for batch in tqdm(dataloader):
+        yield batch.to(device)
+
+
+def _collect_activations(batches, n, dims):
+    pred_arr = np.empty((n, dims))
+
+    start_idx = 0
+
+    for pred in batches:
+        pred = pred.cpu().numpy()
+
+        pred_arr[start_idx:start_idx + pred.shape[0]] = pred
+
+        start_idx = start_idx + pred.shape[0]
+
+    return pred_arr[:start_idx]
+
+
 def get_activations(files, model, batch_size=50, dims=2048, device='cpu',
                     num_workers=1):
     """Calculates the activations of the pool_3 layer for all images.
@@ -108,45 +258,46 @@ def get_activations(files, model, batch_size=50, dims=2048, device='cpu',
        activations of the given tensor when feeding inception with the
        query tensor.
     """
-    model.eval()
-
-    if batch_size > len(files):
-        print(('Warning: batch size is bigger than the data size. '
-               'Setting batch size to data size'))
-        batch_size = len(files)
-
-    dataset = ImagePathDataset(files, transforms=TF.ToTensor())
-    dataloader = torch.utils.data.DataLoader(dataset,
-                                             batch_size=batch_size,
-                                             shuffle=False,
-                                             drop_last=False,
-                                             num_workers=num_workers)
+    batches = _path_activation_batches(files, model, batch_size, device,
+                                       num_workers)
+    return _collect_activations(batches, len(image_dataset(files)), dims)
 
-    pred_arr = np.empty((len(files), dims))
 
-    start_idx = 0
+def _pooled_activations(model, batch):
+    """Runs inception on a batch in range (0, 1) and returns (B, dims)
+    features"""
+    with torch.no_grad():
+        pred = model(batch)[0]
 
-    for batch in tqdm(dataloader):
-        batch = batch.to(device)
+    # If model output is not scalar, apply global spatial average pooling.
+    # This happens if you choose a dimensionality not equal 2048.
+    if pred.size(2) != 1 or pred.size(3) != 1:
+        pred = adaptive_avg_pool2d(pred, output_size=(1, 1))
 
-        with torch.no_grad():
-            pred = model(batch)[0]
+    return pred.squeeze(3).squeeze(2)
 
-        # If model output is not scalar, apply global spatial average pooling.
-        # This happens if you choose a dimensionality not equal 2048.
-        if pred.size(2) != 1 or pred.size(3) != 1:
-            pred = adaptive_avg_pool2d(pred, output_size=(1, 1))
 
-        pred = pred.squeeze(3).squeeze(2).cpu().numpy()
+def generated_to_inception_input(imgs):
+    """Maps generator output in range (-1, 1) to the (0, 1) range inception
+    expects.
 
-        pred_arr[start_idx:start_idx + pred.shape[0]] = pred
+    Values are quantized to 8 bits exactly like `torchvision.utils.save_image`
+    followed by `ToTensor` does, so the in-memory path scores the same images
+    the on-disk path would have written.
+    """
+    if isinstance(imgs, (list, tuple)):
+        # Multi-resolution generators (FastGAN) return the full resolution
+        # output first.
+        imgs = imgs[0]
+    imgs = imgs.add(1).mul(0.5)
+    return imgs.mul(255).add(0.5).clamp(0, 255).floor().div(255)
 
-        start_idx = start_idx + pred.shape[0]
 
-    return pred_arr
+SQRTM_METHODS = ('scipy', 'eigh', 'newton_schulz')
 
 
-def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
+def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6,
+                               method='scipy', device=None):
     """Numpy implementation of the Frechet Distance.
     The Frechet distance between two multivariate Gaussians X_1 ~ N(mu_1, C_1)
     and X_2 ~ N(mu_2, C_2) is
@@ -163,16 +314,26 @@ def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
     -- sigma1: The covariance matrix over activations for generated samples.
     -- sigma2: The covariance matrix over activations, precalculated on an
                representative data set.
+    -- method: How Tr(sqrt(C_1*C_2)) is computed. 'scipy' uses
+               `scipy.linalg.sqrtm` on CPU. 'eigh' and 'newton_schulz' run in
+               float64 torch, see `trace_sqrt_product`, and are much faster.
+    -- device: Device for the torch methods. Defaults to the device of
+               `sigma1` if it is a tensor, else CPU.
 
     Returns:
     --   : The Frechet Distance.
     """
+    assert method in SQRTM_METHODS, \
+        'Unknown sqrtm method {}, choose from {}'.format(method, SQRTM_METHODS)
+    if method != 'scipy':
+        return _calculate_frechet_distance_torch(mu1, sigma1, mu2, sigma2,
+                                                 method, device)
 
-    mu1 = np.atleast_1d(mu1)
-    mu2 = np.atleast_1d(mu2)
+    mu1 = np.atleast_1d(_to_numpy(mu1))
+    mu2 = np.atleast_1d(_to_numpy(mu2))
 
-    sigma1 = np.atleast_2d(sigma1)
-    sigma2 = np.atleast_2d(sigma2)
+    sigma1 = np.atleast_2d(_to_numpy(sigma1))
+    sigma2 = np.atleast_2d(_to_numpy(sigma2))
 
     assert mu1.shape == mu2.shape, \
         'Training and test mean vectors have different lengths'
@@ -203,6 +364,209 @@ def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
             + np.trace(sigma2) - 2 * tr_covmean)
 
 
+def _to_numpy(x):
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return x
+
+
+def _calculate_frechet_distance_torch(mu1, sigma1, mu2, sigma2, method,
+                                      device=None):
+    if device is None:
+        device = sigma1.device if isinstance(sigma1, torch.Tensor) else 'cpu'
+    mu1, sigma1, mu2, sigma2 = [
+        torch.as_tensor(x).to(device, torch.float64)
+        for x in (mu1, sigma1, mu2, sigma2)]
+
+    assert mu1.shape == mu2.shape, \
+        'Training and test mean vectors have different lengths'
+    assert sigma1.shape == sigma2.shape, \
+        'Training and test covariances have different dimensions'
+
+    diff = mu1 - mu2
+    tr_covmean = trace_sqrt_product(sigma1, sigma2, method)
+
+    return (diff.dot(diff) + torch.trace(sigma1)
+            + torch.trace(sigma2) - 2 * tr_covmean).item()
+
+
+def psd_sqrt(sigma):
+    """Square root of a symmetric PSD matrix tensor by eigendecomposition"""
+    eigval, eigvec = torch.linalg.eigh(sigma)
+    # Clamp round-off negatives of the (PSD) covariance
+    return (eigvec * eigval.clamp(min=0).sqrt()) @ eigvec.T
+
+
+def trace_sqrt_product(sigma1, sigma2, method='eigh', n_iters=100,
+                       tol=1e-10, sqrt_sigma1=None):
+    """Tr(sqrt(sigma1 @ sigma2)) of two covariance tensors.
+
+    sigma1 @ sigma2 is similar to the symmetric PSD matrix
+    sqrt(sigma1) @ sigma2 @ sqrt(sigma1), so the trace of its square root is
+    the sum of the square roots of that matrix's eigenvalues.
+
+    Params:
+    -- method  : 'eigh' takes both square roots with symmetric
+                 eigendecompositions. 'newton_schulz' finds sqrt(sigma1) by
+                 eigendecomposition and the second square root with coupled
+                 Newton-Schulz iterations, which are only matrix products.
+    -- n_iters : Maximum number of Newton-Schulz iterations
+    -- tol     : Relative residual at which Newton-Schulz stops early
+    -- sqrt_sigma1 : `psd_sqrt(sigma1)` if already known, e.g. of a
+                 reference covariance used for many FIDs
+    """
+    if sqrt_sigma1 is None:
+        sqrt_sigma1 = psd_sqrt(sigma1)
+    m = sqrt_sigma1 @ sigma2 @ sqrt_sigma1
+    m = (m + m.T) / 2
+
+    if method == 'eigh':
+        return torch.linalg.eigvalsh(m).clamp(min=0).sqrt().sum()
+
+    assert method == 'newton_schulz', 'Unknown method {}'.format(method)
+    norm = torch.linalg.matrix_norm(m)
+    identity = torch.eye(m.shape[0], dtype=m.dtype, device=m.device)
+    y = m / norm
+    z = identity
+    for _ in range(n_iters):
+        t = 0.5 * (3 * identity - z @ y)
+        y = y @ t
+        z = t @ z
+        # y converges to sqrt(m / norm), z to its inverse
+        residual = torch.linalg.matrix_norm(y @ y - m / norm)
+        if residual < tol:
+            break
+    return torch.trace(y) * norm.sqrt()
+
+
+def _subset_fids(act, subsets, mu_ref, sigma_ref, method='scipy',
+                 device=None):
+    """FIDs of subsets of the rows of `act` against a fixed reference.
+
+    `subsets` are index arrays, or None for all of `act`. With the torch
+    methods, the activations and the reference are moved to `device` once and
+    the square root of the reference covariance is taken once for all subsets.
+    """
+    if method == 'scipy':
+        fids = []
+        for i in subsets:
+            sample = act[i] if i is not None else act
+            fids.append(calculate_frechet_distance(
+                np.mean(sample, axis=0), np.cov(sample, rowvar=False),
+                mu_ref, sigma_ref, method=method))
+        return fids
+
+    device = device if device is not None else 'cpu'
+    act = torch.as_tensor(act).to(device, torch.float64)
+    mu_ref, sigma_ref = [torch.as_tensor(x).to(device, torch.float64)
+                         for x in (mu_ref, sigma_ref)]
+    sqrt_ref = psd_sqrt(sigma_ref)
+    fids = []
+    for i in subsets:
+        sample = act[torch.as_tensor(i, device=device)] if i is not None \
+            else act
+        mu, sigma = sample.mean(0), torch.cov(sample.T)
+        diff = mu - mu_ref
+        tr_covmean = trace_sqrt_product(sigma_ref, sigma, method,
+                                        sqrt_sigma1=sqrt_ref)
+        fids.append((diff.dot(diff) + torch.trace(sigma)
+                     + torch.trace(sigma_ref) - 2 * tr_covmean).item())
+    return fids
+
+
+def check_sqrtm_methods(dims=2048, n_samples=None, n_trials=2, seed=0,
+                        device='cpu'):
+    """Relative deviation of the torch sqrtm methods from scipy.
+
+    Each trial draws two sets of `n_samples` (default dims // 2) correlated
+    random activations, so that both covariances are rank-deficient like those
+    of a few thousand Inception features, and compares their FID computed
+    with every method against `method='scipy'`.
+
+    Returns:
+    -- Dict of the largest relative error over the trials, per method
+    """
+    rng = np.random.RandomState(seed)
+    if n_samples is None:
+        n_samples = dims // 2
+    errors = dict.fromkeys(SQRTM_METHODS[1:], 0.)
+    for _ in range(n_trials):
+        mixing = rng.randn(dims, dims) / np.sqrt(dims)
+        act1 = rng.randn(n_samples, dims) @ mixing
+        act2 = rng.randn(n_samples, dims) @ mixing + 0.1
+        stats = (np.mean(act1, axis=0), np.cov(act1, rowvar=False),
+                 np.mean(act2, axis=0), np.cov(act2, rowvar=False))
+        reference = calculate_frechet_distance(*stats, method='scipy')
+        for method in errors:
+            fid = calculate_frechet_distance(*stats, method=method,
+                                             device=device)
+            errors[method] = max(errors[method],
+                                 abs(fid - reference) / abs(reference))
+    return errors
+
+
+def calculate_fid_bootstrap(act, mu_ref, sigma_ref, n_bootstrap=10,
+                            confidence=0.95, seed=0, method='scipy',
+                            device=None, subset_size=None):
+    """FID of a small set of activations with a confidence interval.
+
+    Resampling with replacement duplicates samples, which inflates the FID so
+    much that its resamples say little about the spread of the point estimate.
+    Instead, `n_bootstrap` subsets of `subset_size` (default N // 2) samples
+    are drawn without replacement (m-out-of-n subsampling). The standard
+    deviation of their FIDs around their mean, rescaled from m to N samples
+    by sqrt(m / (N - m)) (1 for half samples), gives a normal interval around
+    the FID of all samples, which is usable with only ~10 subsets.
+
+    Params:
+    -- act         : Numpy array (N, dims) of activations, typically a few
+                     thousand samples
+    -- mu_ref      : Mean of the reference activations
+    -- sigma_ref   : Covariance of the reference activations
+    -- n_bootstrap : Number of subsets of `act`
+    -- confidence  : Coverage of the interval
+    -- seed        : Seed of the subsampling
+    -- method      : sqrtm method, see `calculate_frechet_distance`
+    -- device      : Device of the torch sqrtm methods
+    -- subset_size : Samples per subset, between 2 and N - 1
+
+    Returns:
+    -- fid         : FID of all of `act`
+    -- (lo, hi)   : Confidence interval of the FID
+    """
+    rng = np.random.RandomState(seed)
+    n = len(act)
+    m = subset_size if subset_size is not None else n // 2
+    assert 2 <= m < n, 'subset_size must be between 2 and {}'.format(n - 1)
+    subsets = [None] + [rng.choice(n, m, replace=False)
+                        for _ in range(n_bootstrap)]
+    fid, *fids = _subset_fids(act, subsets, mu_ref, sigma_ref, method, device)
+    std = np.std(fids, ddof=1) * np.sqrt(m / (n - m))
+    half_width = norm.ppf(0.5 + confidence / 2) * std
+    return fid, (max(fid - half_width, 0.), fid + half_width)
+
+
+def calculate_fid_infinity(act, mu_ref, sigma_ref, n_points=10, min_size=None,
+                           seed=0, method='scipy', device=None):
+    """Bias-corrected FID extrapolated to an infinite number of samples.
+
+    FID is biased upwards with a bias roughly linear in 1/N. It is computed on
+    `n_points` random subsets of sizes between `min_size` (default N // 5) and
+    N, and a line fitted to FID against 1/N is evaluated at 1/N = 0
+    (Chong & Forsyth, "Effectively Unbiased FID and Inception Score and where
+    to find them").
+    """
+    rng = np.random.RandomState(seed)
+    n = len(act)
+    if min_size is None:
+        min_size = max(n // 5, 2)
+    sizes = np.linspace(min_size, n, n_points).astype(int)
+    subsets = [rng.choice(n, size, replace=False) for size in sizes]
+    fids = _subset_fids(act, subsets, mu_ref, sigma_ref, method, device)
+    slope, intercept = np.polyfit(1 / sizes, fids, 1)
+    return intercept
+
+
 def calculate_activation_statistics(files, model, batch_size=50, dims=2048,
                                     device='cpu', num_workers=1):
     """Calculation of the statistics used by the FID.
@@ -222,28 +586,98 @@ def calculate_activation_statistics(files, model, batch_size=50, dims=2048,
     -- sigma : The covariance matrix of the activations of the pool_3 layer of
                the inception model.
     """
-    act = get_activations(files, model, batch_size, dims, device, num_workers)
-    mu = np.mean(act, axis=0)
-    sigma = np.cov(act, rowvar=False)
-    return mu, sigma
+    stats = ActivationStatistics(dims, device)
+    for pred in _path_activation_batches(files, model, batch_size, device,
+                                         num_workers):
+        stats.update(pred)
+    return stats.compute()
+
+
+def list_image_files(path):
+    """Sorted list of the image files directly inside `path`, or of its .npy
+    image shards if it holds no image files.
+
+    The listing comes from the persisted file index of the directory, see
+    `utils.file_index.load_file_index`.
+    """
+    index = load_file_index(path)
+    files = [name for name in index
+             if os.path.splitext(name)[1][1:].lower() in IMAGE_EXTENSIONS]
+    if not files:
+        files = [name for name in index if name.endswith('.npy')]
+    return [pathlib.Path(path) / name for name in files]
+
+
+def select_portion(files, portion=1.0):
+    """Deterministic random subset of `files` used for reference statistics"""
+    if portion == 1.0:
+        return files
+    idx_full = np.arange(len(files))
+    np.random.RandomState(0).shuffle(idx_full)
+    idx_calc = np.sort(idx_full[:int(len(files) * portion)])
+    return [files[i] for i in idx_calc]
+
+
+def statistics_cache_key(files, dims, portion=1.0):
+    """Content hash of an image set and the settings its statistics depend on.
+
+    File names are taken relative to their directory, so a copied dataset
+    with preserved sizes and mtimes maps to the same key. Every file is
+    stat-ed rather than read from the directory's file index, which is only
+    revalidated by the directory mtime and so misses files replaced in place;
+    this is cheap next to the Inception pass the key saves.
+    """
+    h = hashlib.sha1()
+    h.update('dims={};portion={}\n'.format(dims, portion).encode())
+    for file in files:
+        st = os.stat(file)
+        h.update('{}\t{}\t{}\n'.format(os.path.basename(file), st.st_size,
+                                       st.st_mtime_ns).encode())
+    return h.hexdigest()
 
 
 def compute_statistics_of_path(path, model, batch_size, dims, device,
-                               num_workers=1):
+                               num_workers=1, portion=1.0,
+                               cache_dir=STATS_CACHE_DIR):
+    """Statistics of a .npz file or of the images in a directory.
+
+    For directories the result is looked up in (and on a miss stored to)
+    `cache_dir` under `statistics_cache_key`. Pass `cache_dir=None` to always
+    recompute, e.g. for freshly generated images.
+    """
     if path.endswith('.npz'):
         with np.load(path) as f:
             m, s = f['mu'][:], f['sigma'][:]
-    else:
-        path = pathlib.Path(path)
-        files = sorted([file for ext in IMAGE_EXTENSIONS
-                       for file in path.glob('*.{}'.format(ext))])
-        m, s = calculate_activation_statistics(files, model, batch_size,
-                                               dims, device, num_workers)
+        return m, s
+
+    files = select_portion(list_image_files(path), portion)
+    if len(files) == 0:
+        raise RuntimeError('No images found in: %s' % path)
+
+    cache_path = None
+    if cache_dir is not None:
+        key = statistics_cache_key(files, dims, portion)
+        cache_path = os.path.join(cache_dir, key + '.npz')
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as f:
+                return f['mu'][:], f['sigma'][:]
+
+    m, s = calculate_activation_statistics(files, model, batch_size,
+                                           dims, device, num_workers)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary name first so that an interrupted run never
+        # leaves a truncated file behind under a valid key
+        tmp_path = cache_path + '.tmp.%d.npz' % os.getpid()
+        np.savez(tmp_path, mu=m, sigma=s)
+        os.replace(tmp_path, cache_path)
 
     return m, s
 
 
-def calculate_fid_given_paths(paths, batch_size, device, dims, num_workers=1):
+def calculate_fid_given_paths(paths, batch_size, device, dims, num_workers=1,
+                              portion=1.0, sqrtm_method='scipy'):
     """Calculates the FID of two paths"""
     for p in paths:
         if not os.path.exists(p):
@@ -253,11 +687,16 @@ def calculate_fid_given_paths(paths, batch_size, device, dims, num_workers=1):
 
     model = InceptionV3([block_idx]).to(device)
 
+    # The first path holds generated images which change on every call, only
+    # the reference statistics are worth caching
     m1, s1 = compute_statistics_of_path(paths[0], model, batch_size,
-                                        dims, device, num_workers)
+                                        dims, device, num_workers,
+                                        cache_dir=None)
     m2, s2 = compute_statistics_of_path(paths[1], model, batch_size,
-                                        dims, device, num_workers)
-    fid_value = calculate_frechet_distance(m1, s1, m2, s2)
+                                        dims, device, num_workers,
+                                        portion=portion)
+    fid_value = calculate_frechet_distance(m1, s1, m2, s2,
+                                           method=sqrtm_method, device=device)
 
     return fid_value
 
@@ -270,6 +709,16 @@ def main():
     else:
         device = torch.device(args.device)
 
+    if args.check_sqrtm:
+        errors = check_sqrtm_methods(args.dims, device=device)
+        for method, error in errors.items():
+            print('{}: relative error {:.2e} against scipy'.format(method,
+                                                                   error))
+        return
+
+    if len(args.path) != 2:
+        parser.error('expected two paths')
+
     if args.num_workers is None:
         num_avail_cpus = len(os.sched_getaffinity(0))
         num_workers = min(num_avail_cpus, 8)
@@ -280,7 +729,8 @@ def main():
                                           args.batch_size,
                                           device,
                                           args.dims,
-                                          num_workers)
+                                          num_workers,
+                                          sqrtm_method=args.sqrtm)
     print('FID: ', fid_value)
 
 
@@ -0,0 +1,90 @@
+"""Persisted listing of a dataset directory, so that large folders are not globbed on every launch."""
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = '.file_index.json'
+
+# manifests of directories that cannot be written to are kept here instead
+INDEX_CACHE_DIR = os.environ.get('FILE_INDEX_CACHE',
+                                 os.path.join(os.path.expanduser('~'), '.cache', 'gan-ada', 'file_index'))
+
+
+def _manifest_paths(data_dir):
+    """Manifest locations of a directory, in the order they are tried"""
+    key = hashlib.sha1(os.path.abspath(data_dir).encode()).hexdigest()
+    return [os.path.join(data_dir, MANIFEST_NAME), os.path.join(INDEX_CACHE_DIR, key + '.json')]
+
+
+def _read_manifest(data_dir):
+    dir_mtime = os.stat(data_dir).st_mtime_ns
+    for path in _manifest_paths(data_dir):
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            continue
+        # adding, removing or renaming files changes the mtime of the directory
+        if manifest.get('dir_mtime_ns') == dir_mtime and manifest.get('data_dir') == os.path.abspath(data_dir):
+            return manifest
+    return None
+
+
+def _write_manifest(data_dir, manifest):
+    for path in _manifest_paths(data_dir):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not os.path.exists(path):
+                # creating the file changes the directory mtime, so create it first and record the mtime after
+                open(path, 'a').close()
+            manifest['dir_mtime_ns'] = os.stat(data_dir).st_mtime_ns
+            # rewriting an existing file leaves the directory untouched; a truncated manifest is rebuilt on read
+            with open(path, 'w') as f:
+                json.dump(manifest, f)
+            return path
+        except OSError:
+            # read-only data dir, try the cache dir
+            continue
+    return None
+
+
+def _scan(data_dir):
+    files = {}
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            if entry.name == MANIFEST_NAME or not entry.is_file():
+                continue
+            st = entry.stat()
+            files[entry.name] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    return files
+
+
+def load_file_index(data_dir, extensions=None, refresh=False):
+    """
+    Sorted {file name: {'size', 'mtime_ns'}} of the files directly inside data_dir.
+
+    The listing is persisted to a manifest in data_dir (or under INDEX_CACHE_DIR if data_dir is read-only) and reused
+    as long as the directory mtime is unchanged, i.e. no file was added, removed or renamed. Files overwritten in
+    place are not noticed; pass refresh=True to rescan.
+
+    :param extensions: Only files with one of these (lower case, no dot) extensions are returned.
+    """
+    manifest = None if refresh else _read_manifest(data_dir)
+    changed = manifest is None
+    if manifest is None:
+        manifest = {'data_dir': os.path.abspath(data_dir), 'files': _scan(data_dir)}
+
+    files = manifest['files']
+    if extensions is not None:
+        extensions = {ext.lower() for ext in extensions}
+        files = {name: entry for name, entry in files.items()
+                 if os.path.splitext(name)[1][1:].lower() in extensions}
+
+    if changed:
+        _write_manifest(data_dir, manifest)
+    return dict(sorted(files.items()))
+
+
+def list_files(data_dir, extensions=None):
+    """Sorted paths of the files directly inside data_dir with one of `extensions`, see load_file_index"""
+    return [os.path.join(data_dir, name) for name in load_file_index(data_dir, extensions)]
@@ -0,0 +1,119 @@
+"""Background encoding and writing of generated images."""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+IMAGE_FORMATS = ('png', 'webp', 'npy')
+
+
+def to_uint8_images(imgs):
+    """(B, C, H, W) generator output in range (-1, 1) to a (B, H, W, C) uint8 numpy array, rounded exactly like
+    `torchvision.utils.save_image`"""
+    imgs = imgs.add(1).mul(0.5).mul(255).add(0.5).clamp(0, 255).to('cpu', torch.uint8)
+    return imgs.permute(0, 2, 3, 1).numpy()
+
+
+def _write_images(out_dir, fmt, compress_level, start_idx, imgs):
+    for i, img in enumerate(imgs):
+        img = Image.fromarray(img.squeeze(2) if img.shape[2] == 1 else img)
+        path = os.path.join(out_dir, '%d.%s' % (start_idx + i, fmt))
+        if fmt == 'png':
+            img.save(path, compress_level=compress_level)
+        else:
+            # for lossless webp, `method` trades encoding time for size like the png compression level
+            img.save(path, lossless=True, method=min(compress_level, 6))
+
+
+def _write_shard(out_dir, start_idx, parts):
+    shard = np.concatenate(parts)
+    np.save(os.path.join(out_dir, '%08d.npy' % start_idx), shard)
+
+
+class ImageWriterPool:
+    """Writes batches of generated images from a pool of worker threads (or processes) so that generation never
+    waits on encoding or disk.
+
+    At most `max_pending` write tasks are queued; `put` only blocks when the writers fall that far behind. With
+    `fmt='npy'`, images are stored uncompressed as (N, H, W, C) uint8 shards of `shard_size` images named by the index
+    of their first image, which `utils.fid_score` reads like an image directory. Image i of the run is always written
+    as `i.png`/`i.webp` or as part of the shard covering index i.
+    """
+    def __init__(self, out_dir, fmt='png', compress_level=1, num_workers=4, max_pending=8, shard_size=1000,
+                 processes=False):
+        assert fmt in IMAGE_FORMATS, 'Unknown image format {}, choose from {}'.format(fmt, IMAGE_FORMATS)
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.fmt = fmt
+        self.compress_level = compress_level
+        self.shard_size = shard_size
+
+        executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self._executor = executor(max_workers=num_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+        self._pending, self._pending_start, self._pending_size = [], 0, 0
+
+    def put(self, imgs, start_idx):
+        """Queues generator output in range (-1, 1) as images start_idx, start_idx + 1, ..."""
+        imgs = to_uint8_images(imgs.detach())
+        if self.fmt != 'npy':
+            self._submit(_write_images, self.out_dir, self.fmt, self.compress_level, start_idx, imgs)
+            return
+
+        if self._pending and self._pending_start + self._pending_size != start_idx:
+            self._flush_shard()
+        if not self._pending:
+            self._pending_start = start_idx
+        self._pending.append(imgs)
+        self._pending_size += len(imgs)
+        if self._pending_size >= self.shard_size:
+            self._flush_shard()
+
+    def _flush_shard(self):
+        if self._pending:
+            self._submit(_write_shard, self.out_dir, self._pending_start, self._pending)
+        self._pending, self._pending_size = [], 0
+
+    def _submit(self, fn, *args):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        self._check_errors()
+
+    def _check_errors(self):
+        pending = []
+        for future in self._futures:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        self._futures = pending
+
+    def close(self):
+        """Writes the last pending shard and waits for all writes to finish"""
+        try:
+            if self.fmt == 'npy':
+                self._flush_shard()
+            for future in self._futures:
+                future.result()
+            self._futures = []
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait=True)
@@ -33,7 +33,8 @@ class InceptionV3(nn.Module):
                  resize_input=True,
                  normalize_input=True,
                  requires_grad=False,
-                 use_fid_inception=True):
+                 use_fid_inception=True,
+                 output_logits=False):
         """Build pretrained InceptionV3
 
         Parameters
@@ -63,6 +64,11 @@ class InceptionV3(nn.Module):
             Inception model. If you want to compute FID scores, you are
             strongly advised to set this parameter to true to get comparable
             results.
+        output_logits : bool
+            If true, the classifier logits computed from the final average
+            pooling features are appended to the returned outputs, so pool3
+            features and logits come from a single forward pass. Requires
+            block 3.
         """
         super(InceptionV3, self).__init__()
 
@@ -73,6 +79,9 @@ class InceptionV3(nn.Module):
 
         assert self.last_needed_block <= 3, \
             'Last possible output block index is 3'
+        self.output_logits = output_logits
+        assert not output_logits or self.last_needed_block == 3, \
+            'Logits need the final average pooling block'
 
         self.blocks = nn.ModuleList()
 
@@ -123,6 +132,9 @@ class InceptionV3(nn.Module):
             ]
             self.blocks.append(nn.Sequential(*block3))
 
+        if self.output_logits:
+            self.fc = inception.fc
+
         for param in self.parameters():
             param.requires_grad = requires_grad
 
@@ -138,7 +150,8 @@ class InceptionV3(nn.Module):
         Returns
         -------
         List of torch.autograd.Variable, corresponding to the selected output
-        block, sorted ascending by index
+        block, sorted ascending by index, followed by the logits if
+        `output_logits` is set
         """
         outp = []
         x = inp
@@ -160,6 +173,9 @@ class InceptionV3(nn.Module):
             if idx == self.last_needed_block:
                 break
 
+        if self.output_logits:
+            outp.append(self.fc(torch.flatten(x, 1)))
+
         return outp
 
 
@@ -0,0 +1,52 @@
+"""Deterministic generator noise addressed by (seed, index)."""
+import hashlib
+
+import torch
+
+
+class LatentBank:
+    """Sample i of a bank is the same whatever the batch size, the number of
+    processes it is split over or the device it is used on.
+
+    The index space is cut into chunks of `chunk_size` samples, and every chunk
+    is drawn on CPU from its own generator seeded with a hash of
+    (seed, chunk index). Any index range can thus be produced independently,
+    e.g. by one of several evaluation shards.
+    """
+    def __init__(self, seed, latent_dim, chunk_size=1024):
+        self.seed = seed
+        self.latent_dim = latent_dim
+        self.chunk_size = chunk_size
+        self._cached_chunk = (None, None)
+
+    def _chunk(self, chunk_idx):
+        if self._cached_chunk[0] != chunk_idx:
+            digest = hashlib.sha1('{}:{}'.format(self.seed, chunk_idx).encode()).hexdigest()
+            rng = torch.Generator().manual_seed(int(digest[:15], 16))
+            self._cached_chunk = (chunk_idx, torch.randn(self.chunk_size, self.latent_dim, generator=rng))
+        return self._cached_chunk[1]
+
+    def get(self, start, stop, device=None):
+        """Latents of samples start, ..., stop - 1 as a (stop - start, latent_dim) tensor"""
+        parts = []
+        idx = start
+        while idx < stop:
+            chunk_idx, offset = divmod(idx, self.chunk_size)
+            n = min(stop - idx, self.chunk_size - offset)
+            parts.append(self._chunk(chunk_idx)[offset:offset + n])
+            idx += n
+        latents = torch.cat(parts) if parts else torch.empty(0, self.latent_dim)
+        return latents.to(device) if device is not None else latents
+
+    def batches(self, start, stop, batch_size, device=None):
+        """Yields the latents of [start, stop) in batches of `batch_size`, the last one possibly smaller"""
+        for batch_start in range(start, stop, batch_size):
+            yield self.get(batch_start, min(batch_start + batch_size, stop), device)
+
+
+def shard_range(n_sample, shard_index, num_shards):
+    """Contiguous [start, stop) index range of one of `num_shards` shards of n_sample samples"""
+    assert 0 <= shard_index < num_shards, 'Shard index must be in [0, num_shards)'
+    start = n_sample * shard_index // num_shards
+    stop = n_sample * (shard_index + 1) // num_shards
+    return start, stop
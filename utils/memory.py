@@ -0,0 +1,86 @@
+"""Garbage collection and device cache policy of the training and generation loops."""
+import gc
+import time
+
+import torch
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is then not reported
+    resource = None
+
+
+class MemoryPolicy:
+    """
+    Replaces blanket gc.collect() calls in the loops. Tensors are freed by reference counting as soon as they go out
+    of scope; the cyclic garbage collector only matters for reference cycles, so it is run every `gc_interval` steps
+    (0: only by Python's automatic thresholds) instead of every step.
+
+    :param gc_interval: Steps between explicit collections of generation `gc_generation`, 0 to disable.
+    :param freeze: Move everything allocated during setup (models, datasets, ...) to the permanent generation in
+        `freeze()`, so that collections no longer traverse it.
+    :param empty_cache_threshold: Fraction of the device memory above which the CUDA caching allocator's reserved
+        memory is released with torch.cuda.empty_cache(), checked every step. None to never release.
+    :param device: Device whose memory is checked and reported.
+    """
+    def __init__(self, gc_interval=0, gc_generation=2, freeze=True, empty_cache_threshold=None, device=None):
+        self.gc_interval = gc_interval
+        self.gc_generation = gc_generation
+        self.freeze_after_setup = freeze
+        self.empty_cache_threshold = empty_cache_threshold
+        self.device = torch.device(device if device is not None else 'cpu')
+        self.cuda = self.device.type == 'cuda'
+        self.steps = 0
+
+        # instrumentation, see stats()
+        self.gc_collections = 0
+        self.gc_time = 0.
+        self.empty_cache_calls = 0
+        self._gc_start = None
+        gc.callbacks.append(self._on_gc)
+
+    def _on_gc(self, phase, info):
+        if phase == 'start':
+            self._gc_start = time.perf_counter()
+        elif self._gc_start is not None:
+            self.gc_time += time.perf_counter() - self._gc_start
+            self.gc_collections += 1
+            self._gc_start = None
+
+    def freeze(self):
+        """To be called once setup is done, before the loop"""
+        if self.freeze_after_setup:
+            gc.collect()
+            gc.freeze()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def step(self):
+        """To be called once per step of the loop"""
+        self.steps += 1
+        if self.gc_interval and self.steps % self.gc_interval == 0:
+            gc.collect(self.gc_generation)
+        if self.empty_cache_threshold is not None and self.cuda:
+            total = torch.cuda.get_device_properties(self.device).total_memory
+            if torch.cuda.memory_reserved(self.device) > self.empty_cache_threshold * total:
+                torch.cuda.empty_cache()
+                self.empty_cache_calls += 1
+
+    def stats(self):
+        """
+        Peak memory and garbage collection time since the last call, to check that the policy bounds memory without
+        paying for collections every step. The peak RSS on CPU is the maximum over the whole process.
+        """
+        mb = float(1 << 20)
+        stats = {'gc_collections': self.gc_collections, 'gc_time_ms': 1000 * self.gc_time,
+                 'empty_cache_calls': self.empty_cache_calls}
+        if self.cuda:
+            stats['peak_allocated_mb'] = torch.cuda.max_memory_allocated(self.device) / mb
+            stats['peak_reserved_mb'] = torch.cuda.max_memory_reserved(self.device) / mb
+            torch.cuda.reset_peak_memory_stats(self.device)
+        if resource is not None:
+            # kilobytes on Linux
+            stats['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+        self.gc_collections, self.gc_time, self.empty_cache_calls = 0, 0., 0
+        return stats
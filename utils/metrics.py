@@ -0,0 +1,255 @@
+"""Generative metrics derived from one shared Inception feature pass.
+
+Pool3 features and classifier logits are extracted together, then FID, KID,
+Inception Score and k-NN precision/recall/density/coverage are all computed
+from the resulting feature matrices without running Inception again.
+"""
+import os
+
+import numpy as np
+import torch
+
+from utils.fid_evaluator import FIDEvaluator, _logits_path
+from utils.fid_score import (STATS_CACHE_DIR, calculate_frechet_distance,
+                             list_image_files, path_image_batches,
+                             select_portion, statistics_cache_key)
+from utils.inception_score import InceptionV3
+
+METRICS = ('fid', 'kid', 'is', 'prdc')
+
+
+def extract_features(model, batches):
+    """Runs an `InceptionV3(output_logits=True)` over image batches in range
+    (0, 1) and returns float32 numpy arrays of pool3 features (N, 2048) and
+    logits (N, 1008)"""
+    model.eval()
+    features, logits = [], []
+    for batch in batches:
+        with torch.no_grad():
+            outp = model(batch)
+        features.append(outp[0].squeeze(3).squeeze(2).float().cpu())
+        logits.append(outp[-1].float().cpu())
+    return torch.cat(features).numpy(), torch.cat(logits).numpy()
+
+
+def calculate_kid(features1, features2, num_subsets=100, max_subset_size=1000,
+                  seed=0, device='cpu'):
+    """Kernel Inception Distance.
+
+    Unbiased MMD^2 estimate with the cubic polynomial kernel
+    k(x, y) = (x.y / dims + 1)^3, averaged over `num_subsets` random blocks
+    of at most `max_subset_size` samples from each set so kernel matrices
+    stay small.
+
+    Returns:
+    -- mean and standard deviation of the per-block estimates
+    """
+    rng = np.random.RandomState(seed)
+    dims = features1.shape[1]
+    m = min(len(features1), len(features2), max_subset_size)
+    kids = []
+    for _ in range(num_subsets):
+        x = features1[rng.choice(len(features1), m, replace=False)]
+        y = features2[rng.choice(len(features2), m, replace=False)]
+        x = torch.as_tensor(x).to(device, torch.float64)
+        y = torch.as_tensor(y).to(device, torch.float64)
+        k_xx = (x @ x.T / dims + 1) ** 3
+        k_yy = (y @ y.T / dims + 1) ** 3
+        k_xy = (x @ y.T / dims + 1) ** 3
+        within = (k_xx.sum() - k_xx.diagonal().sum()
+                  + k_yy.sum() - k_yy.diagonal().sum()) / (m * (m - 1))
+        kids.append((within - 2 * k_xy.sum() / (m * m)).item())
+    return float(np.mean(kids)), float(np.std(kids))
+
+
+def calculate_inception_score(logits, splits=10):
+    """Inception Score exp(E[KL(p(y|x) || p(y))]) over `splits` splits.
+
+    Returns:
+    -- mean and standard deviation over the splits
+    """
+    probs = torch.softmax(torch.as_tensor(logits, dtype=torch.float64),
+                          dim=1).numpy()
+    scores = []
+    for part in np.array_split(probs, splits):
+        p_y = np.mean(part, axis=0, keepdims=True)
+        kl = part * (np.log(part + 1e-12) - np.log(p_y + 1e-12))
+        scores.append(np.exp(np.mean(np.sum(kl, axis=1))))
+    return float(np.mean(scores)), float(np.std(scores))
+
+
+def _knn_radii(features, k, block_size):
+    """Distance of every sample to its k-th nearest neighbour in the same
+    set"""
+    radii = []
+    for start in range(0, len(features), block_size):
+        dist = torch.cdist(features[start:start + block_size], features)
+        # the smallest distance is the sample itself
+        radii.append(dist.kthvalue(k + 1, dim=1).values)
+    return torch.cat(radii)
+
+
+def calculate_prdc(real_features, fake_features, nearest_k=5, block_size=1000,
+                   device='cpu'):
+    """Precision, recall, density and coverage of Naeem et al., "Reliable
+    Fidelity and Diversity Metrics for Generative Models".
+
+    Pairwise distances are computed in blocks of `block_size` rows, so memory
+    is O(block_size * N) rather than O(N^2).
+    """
+    real = torch.as_tensor(real_features).to(device, torch.float32)
+    fake = torch.as_tensor(fake_features).to(device, torch.float32)
+    real_radii = _knn_radii(real, nearest_k, block_size)
+    fake_radii = _knn_radii(fake, nearest_k, block_size)
+
+    precision = density = 0.
+    for start in range(0, len(fake), block_size):
+        dist = torch.cdist(fake[start:start + block_size], real)
+        inside = dist < real_radii[None, :]
+        precision += inside.any(dim=1).sum().item()
+        density += inside.sum().item()
+
+    recall = coverage = 0.
+    for start in range(0, len(real), block_size):
+        dist = torch.cdist(real[start:start + block_size], fake)
+        recall += (dist < fake_radii[None, :]).any(dim=1).sum().item()
+        coverage += (dist.min(dim=1).values
+                     < real_radii[start:start + block_size]).sum().item()
+
+    return {
+        'precision': precision / len(fake),
+        'recall': recall / len(real),
+        'density': density / (nearest_k * len(fake)),
+        'coverage': coverage / len(real),
+    }
+
+
+class MetricsEngine(FIDEvaluator):
+    def __init__(self, ref_path, batch_size, device, metrics=METRICS,
+                 num_workers=1, portion=1.0, prefetch=2, sqrtm_method='scipy',
+                 kid_subsets=100, kid_subset_size=1000, prdc_k=5,
+                 prdc_max_samples=10000, cache_dir=STATS_CACHE_DIR, seed=0,
+                 feature_cache=False):
+        """
+        Params:
+        -- ref_path         : Directory of reference images. A .npz of
+                              statistics only supports 'fid' and 'is'.
+        -- metrics          : Subset of METRICS to compute
+        -- kid_subsets      : Number of random blocks for KID
+        -- kid_subset_size  : Samples per set in each KID block
+        -- prdc_k           : Neighbourhood size for precision/recall/
+                              density/coverage
+        -- prdc_max_samples : Random subset of each set used for the k-NN
+                              metrics
+        -- cache_dir        : Reference features are cached here, keyed like
+                              the FID statistics
+
+        See `FIDEvaluator` for the other parameters.
+        """
+        for metric in metrics:
+            assert metric in METRICS, \
+                'Unknown metric {}, choose from {}'.format(metric, METRICS)
+        self.metrics = tuple(metrics)
+        self.kid_subsets = kid_subsets
+        self.kid_subset_size = kid_subset_size
+        self.prdc_k = prdc_k
+        self.prdc_max_samples = prdc_max_samples
+        self.cache_dir = cache_dir
+        self.ref_features = None
+        super().__init__(ref_path, batch_size, device, dims=2048,
+                         num_workers=num_workers, portion=portion,
+                         prefetch=prefetch, sqrtm_method=sqrtm_method,
+                         seed=seed, feature_cache=feature_cache)
+
+    def _build_inception(self):
+        return InceptionV3([InceptionV3.BLOCK_INDEX_BY_DIM[2048]],
+                           output_logits=True)
+
+    def _reference_statistics(self, ref_path, portion):
+        if ref_path.endswith('.npz'):
+            assert not {'kid', 'prdc'} & set(self.metrics), \
+                ('KID and precision/recall need reference images, not a .npz '
+                 'of statistics')
+            return super()._reference_statistics(ref_path, portion)
+
+        self.ref_features = self._reference_features(ref_path, portion)
+        return (np.mean(self.ref_features, axis=0),
+                np.cov(self.ref_features, rowvar=False))
+
+    def _reference_features(self, ref_path, portion):
+        files = select_portion(list_image_files(ref_path), portion)
+        if len(files) == 0:
+            raise RuntimeError('No images found in: %s' % ref_path)
+
+        cache_path = None
+        if self.cache_dir is not None:
+            key = statistics_cache_key(files, self.dims, portion)
+            cache_path = os.path.join(self.cache_dir,
+                                      key + '-features.npy')
+            if os.path.exists(cache_path):
+                return np.load(cache_path)
+
+        features, _ = extract_features(
+            self.model, path_image_batches(files, self.batch_size,
+                                           self.device, self.num_workers))
+        if cache_path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = cache_path + '.tmp.%d.npy' % os.getpid()
+            np.save(tmp_path, features)
+            os.replace(tmp_path, cache_path)
+        return features
+
+    def _has_cached_features(self, path):
+        # features cached by a plain FID run have no logits
+        return os.path.exists(path) and (
+            'is' not in self.metrics or os.path.exists(_logits_path(path)))
+
+    def compute(self, features, logits):
+        """All configured metrics from the features and logits of generated
+        images, as a flat dict"""
+        results = {}
+        if 'fid' in self.metrics:
+            results['fid'] = calculate_frechet_distance(
+                np.mean(features, axis=0, dtype=np.float64),
+                np.cov(features, rowvar=False), self.mu_ref, self.sigma_ref,
+                method=self.sqrtm_method, device=self.device)
+        if 'kid' in self.metrics:
+            results['kid'], results['kid_std'] = calculate_kid(
+                features, self.ref_features, self.kid_subsets,
+                self.kid_subset_size, device=self.device)
+        if 'is' in self.metrics:
+            results['is'], results['is_std'] = \
+                calculate_inception_score(logits)
+        if 'prdc' in self.metrics:
+            rng = np.random.RandomState(0)
+            real = self.ref_features
+            fake = features
+            if len(real) > self.prdc_max_samples:
+                real = real[rng.choice(len(real), self.prdc_max_samples,
+                                       replace=False)]
+            if len(fake) > self.prdc_max_samples:
+                fake = fake[rng.choice(len(fake), self.prdc_max_samples,
+                                       replace=False)]
+            results.update(calculate_prdc(real, fake, self.prdc_k,
+                                          device=self.device))
+        return results
+
+    def generator_features(self, generator, latent_dim, n_sample):
+        """Features and logits of the first `n_sample` images of the latent
+        bank"""
+        return extract_features(
+            self.model,
+            self._generated_batches(generator, latent_dim, n_sample))
+
+    score_features = compute
+
+    def score_path(self, path):
+        features, logits = extract_features(
+            self.model, path_image_batches(list_image_files(path),
+                                           self.batch_size, self.device,
+                                           self.num_workers))
+        return self.compute(features, logits)
+
+    def score_generator(self, generator, latent_dim, n_sample):
+        return self.compute(*self.generator_features(generator, latent_dim,
+                                                     n_sample))
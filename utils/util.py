@@ -1,9 +1,9 @@
 import json
 import torch
-import pandas as pd
+import numpy as np
 from pathlib import Path
 from itertools import repeat
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import os
 from copy import deepcopy
 
@@ -31,6 +31,90 @@ def inf_loop(data_loader):
     for loader in repeat(data_loader):
         yield from loader
 
+class DevicePrefetcher:
+    """
+    Iterates over a data loader with the next `depth` batches already moved to `device`.
+
+    Copies are issued with non_blocking=True on a side CUDA stream, so with pin_memory set on the loader they overlap
+    the compute of the previous steps. On CPU it iterates the loader unchanged. Other attributes (batch_size,
+    n_samples, ...) are those of the wrapped loader, and it can be wrapped by inf_loop like a loader.
+
+    The loader runs `depth` batches ahead, so state_dict returns the loader's position as of the last batch yielded.
+    """
+    def __init__(self, data_loader, device, depth=2):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self._state = None
+
+    def state_dict(self):
+        if self._state is not None:
+            return self._state
+        return self.data_loader.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.data_loader.load_state_dict(state_dict)
+        self._state = None
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the prefetcher itself
+        if name == 'data_loader':
+            raise AttributeError(name)
+        return getattr(self.data_loader, name)
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            yield from self.data_loader
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        queue = deque()
+        batches = iter(self.data_loader)
+        track = hasattr(self.data_loader, 'state_dict')
+        for batch in batches:
+            with torch.cuda.stream(stream):
+                batch = _to_device(batch, self.device)
+                ready = torch.cuda.Event()
+                ready.record(stream)
+            queue.append((batch, ready, deepcopy(self.data_loader.state_dict()) if track else None))
+            if len(queue) > self.depth:
+                yield self._wait(*queue.popleft())
+        while queue:
+            yield self._wait(*queue.popleft())
+        self._state = None
+
+    def _wait(self, batch, ready, state):
+        self._state = state
+        current = torch.cuda.current_stream(self.device)
+        current.wait_event(ready)
+        # the tensors were allocated on the side stream but are used on the current one
+        _apply_to_tensors(batch, lambda t: t.record_stream(current))
+        return batch
+
+
+def _apply_to_tensors(obj, fn):
+    if isinstance(obj, torch.Tensor):
+        fn(obj)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _apply_to_tensors(item, fn)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            _apply_to_tensors(item, fn)
+
+
+def _to_device(obj, device):
+    if isinstance(obj, torch.Tensor):
+        return obj.to(device, non_blocking=True)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_device(item, device) for item in obj)
+    if isinstance(obj, dict):
+        return {key: _to_device(item, device) for key, item in obj.items()}
+    return obj
+
 def prepare_device(n_gpu_use):
     """
     setup GPU device if available. get gpu device indices which are used for DataParallel
@@ -50,30 +134,90 @@ def prepare_device(n_gpu_use):
 
 
 class MetricTracker:
-    def __init__(self, *keys, writer=None):
+    """
+    Running averages of training metrics, also logged to the writer.
+
+    Totals and counts are kept in NumPy arrays, at a slot per key fixed at construction. Logged values are buffered
+    and written every `flush_interval` updates (and by sync() and result()), each at the writer step and mode of its
+    update, i.e. after the writer has moved on to later steps; the Wandb writer accepts such values, see its __init__.
+
+    Tensor values are read back with .item() on update, which waits for the device. With deferred set, they are
+    kept as tensors instead and read back together, in one transfer, by sync(), which the trainers call at their log
+    steps; avg() and result() sync first.
+    """
+    def __init__(self, *keys, writer=None, deferred=False, flush_interval=1):
         self.writer = writer
-        self._data = pd.DataFrame(index=keys, columns=['total', 'counts', 'average'])
+        self.deferred = deferred
+        self.flush_interval = flush_interval
+        self.keys = keys
+        self._slots = {key: slot for slot, key in enumerate(keys)}
+        self._total = np.zeros(len(keys))
+        self._counts = np.zeros(len(keys))
+        # (slot, tensor, n, writer step) of deferred updates, and (key, value, writer step) of values to log
+        self._pending = []
+        self._logs = []
         self.reset()
 
     def reset(self):
-        for col in self._data.columns:
-            self._data[col].values[:] = 0
+        self._pending = []
+        self._total[:] = 0
+        self._counts[:] = 0
 
     def update(self, key, value, n=1):
-        if self.writer is not None:
+        slot = self._slots[key]
+        if isinstance(value, torch.Tensor):
+            if self.deferred:
+                # a copy, values such as ADA's p are updated in place before the next sync
+                self._pending.append((slot, value.detach().clone(), n, self._writer_step()))
+                return
+            value = value.item()
+        self._update(slot, value, n, self._writer_step())
+        if len(self._logs) >= self.flush_interval:
+            self.flush()
+
+    def sync(self):
+        if self._pending:
+            device = self._pending[0][1].device
+            values = torch.stack([value.float().reshape(()).to(device) for _, value, _, _ in self._pending]).tolist()
+            for (slot, _, n, step), value in zip(self._pending, values):
+                self._update(slot, value, n, step)
+            self._pending = []
+        self.flush()
+
+    def flush(self):
+        """Writes the buffered values to the writer"""
+        if self.writer is None or not self._logs:
+            self._logs = []
+            return
+        current = self._writer_step()
+        for key, value, (step, mode) in self._logs:
+            self.writer.step, self.writer.mode = step, mode
             if self.writer.name == 'wandb':
                 self.writer.log({key: value})
             else:
                 self.writer.add_scalar(key, value)
-        self._data.total[key] += value * n
-        self._data.counts[key] += n
-        self._data.average[key] = self._data.total[key] / self._data.counts[key]
+        self.writer.step, self.writer.mode = current
+        self._logs = []
+
+    def _writer_step(self):
+        return (self.writer.step, self.writer.mode) if self.writer is not None else None
+
+    def _update(self, slot, value, n, step):
+        if self.writer is not None:
+            self._logs.append((self.keys[slot], value, step))
+        self._total[slot] += value * n
+        self._counts[slot] += n
+
+    def _averages(self):
+        return np.divide(self._total, self._counts, out=np.zeros_like(self._total), where=self._counts > 0)
 
     def avg(self, key):
-        return self._data.average[key]
+        self.sync()
+        return self._averages()[self._slots[key]]
 
     def result(self):
-        return dict(self._data.average)
+        self.sync()
+        return dict(zip(self.keys, self._averages().tolist()))
 
 
 def init_wandb(wandb_lib, project, entity, api_key_file='./init/wandb-api-key-file', name=None, config=None):